@@ -0,0 +1,280 @@
+"""Benchmark of the extraction throughput of the models of vpr_models.get_model.
+
+Each method is benchmarked in its own process, sweeping image sizes, batch sizes
+and numbers of threads, on synthetic images or on images decoded from a folder.
+For each combination it reports the images per second, the p50 and p99 latency
+per batch, and the peak RSS of the process, in a JSON file:
+
+    python3 benchmark_models.py --methods cosplace:ResNet50:2048 salad megaloc --device cpu \
+        --image_sizes 322x322 512 --batch_sizes 1 8 32 --num_threads 1 4 16 \
+        --weights_dir path/to/weights --output benchmark.json
+
+With --weights_dir no network is needed, as long as the weights were downloaded
+there before: it must contain the torch.hub folder (hub/, see torch.hub.get_dir())
+and the trained_models/ folder where some models download their weights.
+
+Two result files are compared with
+    python3 benchmark_models.py --compare baseline.json benchmark.json
+which reports the combinations whose throughput, p99 latency or peak RSS got
+worse by more than --regression_threshold, and exits with an error if any did.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from loguru import logger
+
+import parser
+from main import load_model
+from test_dataset import TestDataset, get_resized_size
+
+RESULT_KEYS = ["method", "backbone", "descriptors_dimension", "image_size", "batch_size", "num_threads", "device"]
+
+
+def parse_image_size(image_size):
+    """Parse an image size given as HxW, or as the size of the smallest edge."""
+    return [int(side) for side in image_size.split("x")]
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process, which is only supported on Linux."""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss_mb():
+    """Return the peak RSS of the process since the last reset_peak_rss() (on Linux),
+    or since the process started."""
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == "darwin" else 1024)
+
+
+def get_model_args(spec, device):
+    """Return the arguments of main.py for a method given as method[:backbone[:descriptors_dimension]],
+    with the defaults and checks of parser.check_arguments."""
+    method, backbone, descriptors_dimension = (spec.split(":") + [None, None])[:3]
+    # The database folder is required by the parser, but it is not used
+    argv = ["--database_folder", "", "--method", method, "--device", device]
+    argv += ["--backbone", backbone] if backbone else []
+    argv += ["--descriptors_dimension", descriptors_dimension] if descriptors_dimension else []
+    return parser.check_arguments(parser.get_parser(queries_folder_required=False).parse_args(argv))
+
+
+def get_images(images_folder, image_size, size_multiple, batch_size, synthetic_hw):
+    """Return a batch of batch_size normalized images resized to image_size, decoded
+    from the first images of images_folder (repeated if needed), or synthetic."""
+    if images_folder is None:
+        h, w = get_resized_size(synthetic_hw[1], synthetic_hw[0], image_size, size_multiple)
+        return torch.randn(batch_size, 3, h, w, generator=torch.Generator().manual_seed(0))
+    dataset = TestDataset(images_folder, None, image_size=image_size, use_labels=False, size_multiple=size_multiple)
+    images = [dataset[i][0] for i in range(min(batch_size, len(dataset)))]
+    # Images with a different aspect ratio are resized to the size of the first one
+    images = [
+        torch.nn.functional.interpolate(image[None], images[0].shape[-2:], mode="bilinear")[0] for image in images
+    ]
+    return torch.stack([images[i % len(images)] for i in range(batch_size)])
+
+
+def benchmark_method(spec, args):
+    """Benchmark the model of a method (within the current process) for each
+    combination of image size, batch size and number of threads."""
+    logger.remove()
+    logger.add(sys.stdout, colorize=True, format="<green>{time:%Y-%m-%d %H:%M:%S}</green> {message}", level="INFO")
+    if args.weights_dir is not None:
+        torch.hub.set_dir(os.path.join(args.weights_dir, "hub"))
+        os.chdir(args.weights_dir)
+    model_args = get_model_args(spec, args.device)
+    model = load_model(model_args)
+    # Methods with a fixed input size are only benchmarked at that size
+    input_size = getattr(model, "input_size", None)
+    fixed_image_size = model_args.image_size or (list(input_size) if input_size is not None else None)
+    image_sizes = [fixed_image_size] if fixed_image_size else args.image_sizes
+    size_multiple = getattr(model, "input_size_multiple", None)
+
+    results = []
+    for image_size in image_sizes:
+        for batch_size in args.batch_sizes:
+            images = get_images(args.images_folder, image_size, size_multiple, batch_size, args.synthetic_hw)
+            images = images.to(args.device)
+            for num_threads in args.num_threads:
+                torch.set_num_threads(num_threads)
+                reset_peak_rss()
+                latencies = []
+                with torch.inference_mode():
+                    for i in range(args.num_warmup_batches + args.num_batches):
+                        start_time = time.perf_counter()
+                        model(images)
+                        if args.device == "cuda":
+                            torch.cuda.synchronize()
+                        if i >= args.num_warmup_batches:
+                            latencies.append(time.perf_counter() - start_time)
+                result = {
+                    "method": model_args.method,
+                    "backbone": model_args.backbone,
+                    "descriptors_dimension": model_args.descriptors_dimension,
+                    "image_size": list(image_size) if image_size else None,
+                    "images_shape": list(images.shape[-2:]),
+                    "batch_size": batch_size,
+                    "num_threads": num_threads,
+                    "device": args.device,
+                    "images_per_sec": batch_size * len(latencies) / sum(latencies),
+                    "latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+                    "latency_p99_ms": float(np.percentile(latencies, 99) * 1000),
+                    "peak_rss_mb": get_peak_rss_mb(),
+                }
+                logger.info(
+                    f"{spec} {result['images_shape']} batch {batch_size}, {num_threads} threads: "
+                    f"{result['images_per_sec']:.1f} images/s, p50 {result['latency_p50_ms']:.1f} ms, "
+                    f"p99 {result['latency_p99_ms']:.1f} ms, peak RSS {result['peak_rss_mb']:.0f} MB"
+                )
+                results.append(result)
+    return results
+
+
+def get_environment():
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "cuda_device": torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+    }
+
+
+def compare_results(baseline, results, threshold):
+    """Return the descriptions of the regressions of results with respect to baseline,
+    i.e. the combinations (present in both) whose images/sec decreased, or whose
+    p99 latency or peak RSS increased, by more than the relative threshold."""
+    get_key = lambda result: json.dumps([result[key] for key in RESULT_KEYS])
+    baseline_per_key = {get_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        old = baseline_per_key.get(get_key(result))
+        if old is None:
+            continue
+        name = ", ".join(f"{key}={result[key]}" for key in RESULT_KEYS)
+        changes = {
+            "images_per_sec": 1 - result["images_per_sec"] / old["images_per_sec"],
+            "latency_p99_ms": result["latency_p99_ms"] / old["latency_p99_ms"] - 1,
+            "peak_rss_mb": result["peak_rss_mb"] / old["peak_rss_mb"] - 1,
+        }
+        changes_str = ", ".join(f"{metric} {old[metric]:.1f} -> {result[metric]:.1f}" for metric in changes)
+        is_regression = any(change > threshold for change in changes.values())
+        logger.info(f"{'REGRESSION ' if is_regression else ''}{name}: {changes_str}")
+        if is_regression:
+            regressions.append(f"{name}: {changes_str}")
+    return regressions
+
+
+def parse_arguments():
+    arg_parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument(
+        "--methods",
+        type=str,
+        nargs="+",
+        default=["cosplace:ResNet50:2048"],
+        help="methods to benchmark, as method[:backbone[:descriptors_dimension]]",
+    )
+    arg_parser.add_argument(
+        "--image_sizes",
+        type=parse_image_size,
+        nargs="+",
+        default=[[512, 512]],
+        help="image sizes, as HxW or as the size of the smallest edge. Methods with a fixed input size only use it",
+    )
+    arg_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32], help="_")
+    arg_parser.add_argument("--num_threads", type=int, nargs="+", default=[torch.get_num_threads()], help="_")
+    arg_parser.add_argument("--num_batches", type=int, default=20, help="number of timed batches per combination")
+    arg_parser.add_argument("--num_warmup_batches", type=int, default=3, help="_")
+    arg_parser.add_argument("--device", type=str, default="cpu", choices=["cuda", "cpu"], help="_")
+    arg_parser.add_argument(
+        "--images_folder",
+        type=str,
+        default=None,
+        help="folder of images to benchmark on (e.g. a database). If not set, synthetic images are used",
+    )
+    arg_parser.add_argument(
+        "--synthetic_hw",
+        type=parse_image_size,
+        default=[480, 640],
+        help="HxW of the synthetic images before resizing to --image_sizes",
+    )
+    arg_parser.add_argument(
+        "--weights_dir",
+        type=str,
+        default=None,
+        help="folder with the downloaded weights (hub/ and trained_models/), so that no network is needed",
+    )
+    arg_parser.add_argument("--output", type=str, default="benchmark.json", help="path of the JSON with the results")
+    arg_parser.add_argument(
+        "--compare",
+        type=str,
+        nargs=2,
+        default=None,
+        metavar=("BASELINE", "RESULTS"),
+        help="instead of running the benchmark, compare two result files",
+    )
+    arg_parser.add_argument(
+        "--regression_threshold",
+        type=float,
+        default=0.1,
+        help="relative change of images/sec, p99 latency or peak RSS above which it is a regression",
+    )
+    args = arg_parser.parse_args()
+    # Paths are used from the benchmark processes, which run within --weights_dir
+    for name in ["images_folder", "weights_dir"]:
+        if getattr(args, name) is not None:
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    return args
+
+
+def main(args):
+    logger.remove()
+    logger.add(sys.stdout, colorize=True, format="<green>{time:%Y-%m-%d %H:%M:%S}</green> {message}", level="INFO")
+    if args.compare is not None:
+        with open(args.compare[0], "r") as file:
+            baseline = json.load(file)
+        with open(args.compare[1], "r") as file:
+            results = json.load(file)
+        regressions = compare_results(baseline, results, args.regression_threshold)
+        if regressions:
+            logger.info(f"{len(regressions)} regressions above {args.regression_threshold:.0%}")
+            sys.exit(1)
+        logger.info("No regressions")
+        return
+
+    logger.info(" ".join(sys.argv))
+    logger.info(f"Arguments: {args}")
+    results = []
+    for spec in args.methods:
+        # A new process per method, so that the peak RSS and the threads of a method don't affect the others
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results.extend(executor.submit(benchmark_method, spec, args).result())
+    with open(args.output, "w") as file:
+        json.dump({"environment": get_environment(), "arguments": vars(args), "results": results}, file, indent=2)
+    logger.info(f"Saved the results in {args.output}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
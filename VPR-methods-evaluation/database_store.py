@@ -0,0 +1,233 @@
+"""Persistent, incrementally updatable store of the database descriptors and
+of their FAISS index, so that when images are added to (or removed from) the
+database only the new images need to be processed, instead of re-extracting
+all descriptors and rebuilding the index.
+
+Each image of the store has an id, which is also its id within the index
+(a faiss.IndexIDMap2). Removed images are tombstoned: they are removed from the
+index when the index supports it, otherwise they are filtered out of the
+search results, and their descriptors stay on disk until compact() is called,
+which drops them and renumbers the ids of the remaining images.
+
+The store folder contains:
+- config.json, the configuration of the model which extracted the descriptors,
+  and the index factory and number of training descriptors of the index
+- images.tsv, with one line id, path, UTM east, UTM north, chunk, row, alive per image
+- chunk_*.npy, the descriptors added by each update
+- index.faiss, the index of the descriptors
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from images_index import parse_images_fields
+from indexes import sample_descriptors
+
+
+class DatabaseStore:
+    """Database descriptors and index stored in folder, built with model_config
+    (see DescriptorsCache) and index_factory (see indexes.build_index), and trained
+    on train_size descriptors of the first images added."""
+
+    def __init__(self, folder, model_config, index_factory="Flat", train_size=100000):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.index_factory = index_factory
+        self.train_size = train_size
+        config = {"model_config": model_config, "index_factory": index_factory, "train_size": train_size}
+        config_path = self.folder / "config.json"
+        if config_path.exists():
+            stored_config = json.loads(config_path.read_text())
+            if stored_config != json.loads(json.dumps(config)):
+                raise ValueError(f"The store {folder} was built with a different configuration: {stored_config}")
+        else:
+            config_path.write_text(json.dumps(config, sort_keys=True, indent=2))
+
+        self.paths, utms, self.chunks, self.rows, alive = [], [], [], [], []
+        images_path = self.folder / "images.tsv"
+        if images_path.exists():
+            with open(images_path, "r") as file:
+                for line in file.read().splitlines():
+                    _, path, utm_east, utm_north, chunk_name, row, is_alive = line.split("\t")
+                    self.paths.append(path)
+                    utms.append((float(utm_east), float(utm_north)))
+                    self.chunks.append(chunk_name)
+                    self.rows.append(int(row))
+                    alive.append(is_alive == "1")
+        self.utms = np.array(utms, dtype=np.float64).reshape(-1, 2)
+        self.alive = np.array(alive, dtype=bool)
+        self.ids_per_path = {path: i for i, path in enumerate(self.paths) if self.alive[i]}
+        index_path = self.folder / "index.faiss"
+        self.index = faiss.read_index(str(index_path)) if index_path.exists() else None
+        if self.index is not None:
+            indexed_ids = faiss.vector_to_array(self.index.id_map)
+            if indexed_ids.max(initial=-1) >= len(self.paths) or not self.alive[indexed_ids].sum() == len(self):
+                # The index and the images list are out of sync (e.g. after an interrupted update)
+                self.rebuild_index()
+
+    def __len__(self):
+        return len(self.ids_per_path)
+
+    def __repr__(self):
+        return f"< DatabaseStore in {self.folder}; #images: {len(self)}; #tombstones: {len(self.paths) - len(self)} >"
+
+    @property
+    def num_tombstones_in_index(self):
+        return 0 if self.index is None else self.index.ntotal - len(self)
+
+    def get_ids(self, paths):
+        """Return the ids of paths (which must be within the store)."""
+        return np.array([self.ids_per_path[os.path.abspath(path)] for path in paths], dtype=np.int64)
+
+    def get_changes(self, database_paths):
+        """Return the positions within database_paths of the paths which are not
+        in the store, and the ids of the images of the store not in database_paths."""
+        database_paths = [os.path.abspath(path) for path in database_paths]
+        new_positions = [i for i, path in enumerate(database_paths) if path not in self.ids_per_path]
+        removed_ids = sorted(set(self.ids_per_path.values()) - {self.ids_per_path.get(p) for p in database_paths})
+        return new_positions, np.array(removed_ids, dtype=np.int64)
+
+    def read_descriptors(self, ids):
+        """Return the descriptors of the images with the given ids."""
+        ids = np.asarray(ids, dtype=np.int64)
+        descriptors = None
+        chunk_names = np.array(self.chunks, dtype=object)[ids]
+        rows = np.array(self.rows, dtype=np.int64)[ids]
+        for chunk_name in np.unique(chunk_names):
+            chunk = np.load(self.folder / chunk_name, mmap_mode="r")
+            if descriptors is None:
+                descriptors = np.empty((len(ids), chunk.shape[1]), dtype="float32")
+            positions = np.nonzero(chunk_names == chunk_name)[0]
+            descriptors[positions] = chunk[rows[positions]]
+        return descriptors
+
+    def add(self, paths, descriptors):
+        """Append the descriptors of paths (new images) to the store and to the index."""
+        if len(paths) == 0:
+            return
+        paths = [os.path.abspath(path) for path in paths]
+        descriptors = np.ascontiguousarray(descriptors, dtype="float32")
+        chunk_name = f"chunk_{time.time_ns()}_{os.getpid()}.npy"
+        np.save(self.folder / chunk_name, descriptors)
+        ids = np.arange(len(self.paths), len(self.paths) + len(paths))
+        self._add_to_index(descriptors, ids)
+        self.paths.extend(paths)
+        self.utms = np.concatenate([self.utms, parse_images_fields(paths)[0]])
+        self.chunks.extend([chunk_name] * len(paths))
+        self.rows.extend(range(len(paths)))
+        self.alive = np.concatenate([self.alive, np.ones(len(paths), dtype=bool)])
+        self.ids_per_path.update(zip(paths, ids.tolist()))
+
+    def rebuild_index(self):
+        """Build the index from scratch with the descriptors of the alive images."""
+        self.index = None
+        ids = np.nonzero(self.alive)[0]
+        if len(ids) > 0:
+            self._add_to_index(self.read_descriptors(ids), ids)
+
+    def _add_to_index(self, descriptors, ids):
+        if self.index is None:
+            self.index = faiss.IndexIDMap2(faiss.index_factory(descriptors.shape[1], self.index_factory))
+            if not self.index.is_trained:
+                self.index.train(sample_descriptors(descriptors, self.train_size))
+        self.index.add_with_ids(descriptors, ids)
+
+    def remove(self, ids):
+        """Tombstone the images with the given ids."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        self.alive[ids] = False
+        for i in ids:
+            del self.ids_per_path[self.paths[i]]
+        try:
+            self.index.remove_ids(ids)
+        except RuntimeError:
+            pass  # Indexes such as HNSW don't support removals, tombstones are then filtered out by search()
+
+    def search(self, queries_descriptors, k):
+        """Return (distances, ids) of the k nearest alive images of each query,
+        padded with inf and -1 when less than k images are alive."""
+        num_queries = len(queries_descriptors)
+        if self.index is None or len(self) == 0:
+            return np.full((num_queries, k), np.inf, dtype="float32"), np.full((num_queries, k), -1, dtype=np.int64)
+        queries_descriptors = np.ascontiguousarray(queries_descriptors, dtype="float32")
+        distances, ids = self.index.search(queries_descriptors, k + self.num_tombstones_in_index)
+        # Ids beyond the images list can only come from an interrupted update, and are ignored as well
+        is_valid = (ids >= 0) & (ids < len(self.alive))
+        is_valid[is_valid] = self.alive[ids[is_valid]]
+        # A stable sort moves the tombstones to the end, keeping the other results in order
+        order = np.argsort(~is_valid, axis=1, kind="stable")[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        ids = np.take_along_axis(np.where(is_valid, ids, -1), order, axis=1)
+        distances[ids < 0] = np.inf
+        return distances, ids
+
+    def compact(self):
+        """Drop the tombstones, rewriting the descriptors of the alive images into
+        a single chunk and rebuilding the index, and renumber the ids.
+
+        Returns
+        -------
+        old_ids : np.array of int64, old_ids[new_id] is the id before compaction
+        """
+        old_ids = np.nonzero(self.alive)[0]
+        old_chunks = set(self.chunks)
+        paths = [self.paths[i] for i in old_ids]
+        descriptors = self.read_descriptors(old_ids) if len(old_ids) > 0 else np.zeros((0, 0), dtype="float32")
+        self.paths, self.chunks, self.rows = [], [], []
+        self.utms = np.zeros((0, 2), dtype=np.float64)
+        self.alive = np.zeros(0, dtype=bool)
+        self.ids_per_path = {}
+        self.index = None
+        self.add(paths, descriptors)
+        self.save()
+        for chunk_name in old_chunks:
+            (self.folder / chunk_name).unlink()
+        return old_ids
+
+    def save(self):
+        """Write the images list and the index. The chunks are written by add(),
+        and files are replaced atomically, so an interrupted update never leaves
+        the store pointing to missing descriptors."""
+        lines = []
+        for i, (path, (utm_east, utm_north), chunk_name, row, is_alive) in enumerate(
+            zip(self.paths, self.utms, self.chunks, self.rows, self.alive)
+        ):
+            lines.append(f"{i}\t{path}\t{utm_east}\t{utm_north}\t{chunk_name}\t{row}\t{int(is_alive)}\n")
+        with open(self.folder / "images.tsv.tmp", "w") as file:
+            file.write("".join(lines))
+        if self.index is not None:
+            faiss.write_index(self.index, str(self.folder / "index.faiss.tmp"))
+            os.replace(self.folder / "index.faiss.tmp", self.folder / "index.faiss")
+        elif (self.folder / "index.faiss").exists():
+            (self.folder / "index.faiss").unlink()
+        os.replace(self.folder / "images.tsv.tmp", self.folder / "images.tsv")
+
+
+if __name__ == "__main__":
+    # Update the store with the images of --database_folder, e.g.
+    # python3 database_store.py --method=cosplace --database_folder=path/to/database --database_store=path/to/store
+    import parser
+    from main import get_size_multiple, load_model, update_database_store
+    from test_dataset import TestDataset
+
+    args = parser.check_arguments(parser.get_parser(queries_folder_required=False).parse_args())
+    if args.database_store is None:
+        raise ValueError("--database_store must be set")
+    model = load_model(args)
+    database_ds = TestDataset(
+        args.database_folder,
+        None,
+        image_size=args.image_size,
+        use_labels=False,
+        size_multiple=get_size_multiple(model, args),
+        fast_decode=args.fast_decode,
+        image_shards_dir=args.image_shards_dir,
+    )
+    update_database_store(model, database_ds, args)
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+def get_model_hash(model):
+    """Compute a hash of the weights of a model, so that descriptors extracted
+    with different weights are never mixed in the cache."""
+    hasher = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return hasher.hexdigest()
+
+
+def get_file_key(path):
+    """Return (mtime_ns, size) of a file, used to detect images that changed."""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class DescriptorsCache:
+    """On-disk store of descriptors, shared across runs of main.py.
+
+    The cache folder is chosen from a hash of the model configuration (method,
+    backbone, descriptors dimension, image size, weights hash...), and within
+    it each descriptor is keyed by the image absolute path, mtime and size.
+    Each call to write() appends a new chunk file, so descriptors which are
+    already cached are never rewritten.
+
+    Parameters
+    ----------
+    cache_dir : str, root folder of the cache
+    model_config : dict, JSON-serializable configuration which identifies the
+        model that extracts the descriptors
+    """
+
+    def __init__(self, cache_dir, model_config):
+        config_str = json.dumps(model_config, sort_keys=True)
+        self.folder = Path(cache_dir) / hashlib.sha1(config_str.encode()).hexdigest()[:16]
+        self.folder.mkdir(parents=True, exist_ok=True)
+        config_path = self.folder / "config.json"
+        if not config_path.exists():
+            config_path.write_text(json.dumps(model_config, sort_keys=True, indent=2))
+        self.index_path = self.folder / "index.tsv"
+        # Maps path -> (mtime_ns, size, chunk_name, row). Later lines of the
+        # index override previous ones, so that changed images get updated.
+        self.entries = {}
+        if self.index_path.exists():
+            existing_chunks = {path.name for path in self.folder.glob("chunk_*.npy")}
+            with open(self.index_path, "r") as file:
+                for line in file.read().splitlines():
+                    # Lines cut short by a killed run, or pointing to a deleted chunk, are skipped
+                    fields = line.split("\t")
+                    if len(fields) != 5 or fields[3] not in existing_chunks:
+                        continue
+                    path, mtime_ns, size, chunk_name, row = fields
+                    try:
+                        self.entries[path] = (int(mtime_ns), int(size), chunk_name, int(row))
+                    except ValueError:
+                        continue
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f"< DescriptorsCache in {self.folder}; #descriptors: {len(self)} >"
+
+    def get_fingerprint(self, images_paths):
+        """Return a hash of the paths, mtimes and sizes of images_paths, which
+        changes whenever any of the images is added, removed or modified."""
+        hasher = hashlib.sha1()
+        for path in images_paths:
+            mtime_ns, size = get_file_key(path)
+            hasher.update(f"{os.path.abspath(path)}\t{mtime_ns}\t{size}\n".encode())
+        return hasher.hexdigest()[:16]
+
+    def read(self, images_paths, out):
+        """Copy the cached descriptors of images_paths into the corresponding
+        rows of out, which must have shape [len(images_paths), dim].
+
+        Returns
+        -------
+        missing_indices : list[int], positions in images_paths which are not
+            cached (or whose image changed), and need to be extracted
+        """
+        missing_indices = []
+        hits_per_chunk = defaultdict(list)
+        for i, path in enumerate(images_paths):
+            entry = self.entries.get(os.path.abspath(path))
+            if entry is None or entry[:2] != get_file_key(path):
+                missing_indices.append(i)
+            else:
+                hits_per_chunk[entry[2]].append((i, entry[3]))
+        for chunk_name, hits in hits_per_chunk.items():
+            chunk = np.load(self.folder / chunk_name, mmap_mode="r")
+            positions, rows = np.array(hits).T
+            out[positions] = chunk[rows]
+        return missing_indices
+
+    def write(self, images_paths, descriptors):
+        """Append the descriptors of images_paths to the cache."""
+        if len(images_paths) == 0:
+            return
+        assert len(images_paths) == len(descriptors)
+        chunk_name = f"chunk_{time.time_ns()}_{os.getpid()}.npy"
+        np.save(self.folder / chunk_name, np.asarray(descriptors, dtype="float32"))
+        lines = []
+        for row, path in enumerate(images_paths):
+            path = os.path.abspath(path)
+            mtime_ns, size = get_file_key(path)
+            self.entries[path] = (mtime_ns, size, chunk_name, row)
+            lines.append(f"{path}\t{mtime_ns}\t{size}\t{chunk_name}\t{row}\n")
+        # The chunk is written before the index, so the index never points to missing data
+        with open(self.index_path, "a+b") as file:
+            # If a killed run left a partial last line, start on a new one so it doesn't merge with ours
+            if file.tell() > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    lines.insert(0, "\n")
+            file.write("".join(lines).encode())
@@ -0,0 +1,149 @@
+"""Saving and loading of descriptors in compressed formats:
+- float32: plain .npy file, as np.save
+- float16: .npy file of float16, i.e. the codes of FAISS's QT_fp16 quantizer
+- int8: .npy file of uint8 codes of FAISS's per-dimension QT_8bit quantizer,
+  with an additional _params.npy file with the offset (minimum) and scale
+  (maximum - minimum) of each dimension.
+Compressed descriptors are read with DescriptorsReader, which memory-maps the
+codes and decodes them lazily, and can be turned into a FAISS IndexScalarQuantizer
+without re-encoding them.
+"""
+
+import os
+
+import faiss
+import numpy as np
+
+DESCRIPTORS_FORMATS = ["float32", "float16", "int8"]
+
+
+def get_descriptors_path(folder, name, descriptors_format="float32"):
+    """Return the path of the descriptors called name (e.g. database_descriptors)."""
+    suffix = "" if descriptors_format == "float32" else f"_{descriptors_format}"
+    return os.path.join(folder, f"{name}{suffix}.npy")
+
+
+def get_params_path(path):
+    """Return the path of the offset and scale of the int8 descriptors in path."""
+    return path[: -len(".npy")] + "_params.npy"
+
+
+def get_scalar_quantizer(dim, descriptors_format, params=None):
+    """Return the faiss.ScalarQuantizer which encodes descriptors in descriptors_format.
+    params is the [2 x dim] array of offsets and scales of int8 descriptors."""
+    if descriptors_format == "float16":
+        return faiss.ScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16)
+    scalar_quantizer = faiss.ScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit)
+    faiss.copy_array_to_vector(np.ascontiguousarray(params, dtype="float32").reshape(-1), scalar_quantizer.trained)
+    return scalar_quantizer
+
+
+def save_descriptors(path, descriptors, descriptors_format="float32", chunk_size=100000):
+    """Save descriptors (possibly a np.memmap larger than RAM) in path, in chunks.
+
+    Parameters
+    ----------
+    path : str, path of the .npy file, e.g. from get_descriptors_path()
+    descriptors : np.array of shape [num_descriptors x dim]
+    descriptors_format : str, one of DESCRIPTORS_FORMATS
+    chunk_size : int, number of descriptors encoded at a time
+    """
+    if descriptors_format not in DESCRIPTORS_FORMATS:
+        raise ValueError(f"descriptors_format must be one of {DESCRIPTORS_FORMATS}, not {descriptors_format}")
+    num_descriptors, dim = descriptors.shape
+    if descriptors_format == "float32":
+        codes_dtype, scalar_quantizer = "float32", None
+    elif descriptors_format == "float16":
+        codes_dtype, scalar_quantizer = "float16", get_scalar_quantizer(dim, "float16")
+    else:
+        # The offset and scale of each dimension are its range over all descriptors, as FAISS's RS_minmax
+        minimum = np.full(dim, np.inf, dtype="float32")
+        maximum = np.full(dim, -np.inf, dtype="float32")
+        for start in range(0, num_descriptors, chunk_size):
+            chunk = np.asarray(descriptors[start : start + chunk_size], dtype="float32")
+            minimum = np.minimum(minimum, chunk.min(axis=0))
+            maximum = np.maximum(maximum, chunk.max(axis=0))
+        if num_descriptors == 0:
+            minimum, maximum = np.zeros(dim, dtype="float32"), np.zeros(dim, dtype="float32")
+        params = np.stack([minimum, maximum - minimum])
+        np.save(get_params_path(path), params)
+        codes_dtype, scalar_quantizer = "uint8", get_scalar_quantizer(dim, "int8", params)
+
+    codes = np.lib.format.open_memmap(path, mode="w+", dtype=codes_dtype, shape=(num_descriptors, dim))
+    for start in range(0, num_descriptors, chunk_size):
+        chunk = np.ascontiguousarray(descriptors[start : start + chunk_size], dtype="float32")
+        if scalar_quantizer is None:
+            codes[start : start + chunk_size] = chunk
+        else:
+            codes[start : start + chunk_size] = scalar_quantizer.compute_codes(chunk).view(codes_dtype)
+    codes.flush()
+    del codes
+
+
+class DescriptorsReader:
+    """Read-only array-like view of descriptors saved by save_descriptors(), in
+    any of DESCRIPTORS_FORMATS. The codes are memory-mapped, and only the rows
+    which are accessed are decoded to float32, so it can be used in place of a
+    float32 np.memmap (e.g. by search.chunked_search or indexes.build_index).
+
+    Parameters
+    ----------
+    path : str, path of the .npy file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.codes = np.load(path, mmap_mode="r")
+        num_descriptors, dim = self.codes.shape
+        self.shape = (num_descriptors, dim)
+        self.dtype = np.dtype("float32")
+        if self.codes.dtype == np.uint8:
+            self.descriptors_format = "int8"
+            self.scalar_quantizer = get_scalar_quantizer(dim, "int8", np.load(get_params_path(path)))
+        elif self.codes.dtype == np.float16:
+            self.descriptors_format = "float16"
+            self.scalar_quantizer = get_scalar_quantizer(dim, "float16")
+        else:
+            self.descriptors_format = "float32"
+            self.scalar_quantizer = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f"< DescriptorsReader of {self.path}; format: {self.descriptors_format}; shape: {self.shape} >"
+
+    def decode(self, codes):
+        """Return the float32 descriptors of codes, an array of shape [num_descriptors x dim]."""
+        if self.scalar_quantizer is None:
+            return np.asarray(codes, dtype="float32")
+        return self.scalar_quantizer.decode(np.ascontiguousarray(codes).view("uint8"))
+
+    def __getitem__(self, key):
+        codes = self.codes[key]
+        if codes.ndim == 1:
+            return self.decode(codes[None])[0]
+        return self.decode(codes)
+
+    def iter_chunks(self, chunk_size=100000):
+        """Yield (start, descriptors) for consecutive chunks of chunk_size descriptors."""
+        for start in range(0, len(self), chunk_size):
+            yield start, self[start : start + chunk_size]
+
+    def to_faiss_index(self, chunk_size=100000):
+        """Return a FAISS index which contains the descriptors: an IndexScalarQuantizer
+        with the same quantizer for float16 and int8 (the codes are copied without
+        being decoded), or an IndexFlatL2 for float32."""
+        if self.scalar_quantizer is None:
+            index = faiss.IndexFlatL2(self.shape[1])
+        else:
+            index = faiss.IndexScalarQuantizer(self.shape[1], self.scalar_quantizer.qtype, faiss.METRIC_L2)
+            index.sq.trained = self.scalar_quantizer.trained
+            index.is_trained = True
+        for start in range(0, len(self), chunk_size):
+            codes = np.ascontiguousarray(self.codes[start : start + chunk_size])
+            if self.scalar_quantizer is None:
+                index.add(codes)
+            else:
+                index.add_sa_codes(codes.view("uint8"))
+        return index
@@ -0,0 +1,75 @@
+"""Vectorized computation of recalls, shared by main.py, reranking.py and the
+analysis tools. Instead of looping over queries, the correctness of the whole
+[num_queries x k] prediction matrix is computed in a single pass.
+"""
+
+import numpy as np
+
+from positives import Positives
+
+
+def _to_csr(positives_per_query):
+    """Return (starts, ends, indices) from a Positives or from a sequence of arrays."""
+    if isinstance(positives_per_query, Positives):
+        return positives_per_query.starts, positives_per_query.ends, positives_per_query.indices
+    counts = np.array([len(positives) for positives in positives_per_query], dtype=np.int64)
+    ends = np.cumsum(counts)
+    indices = [np.asarray(positives, dtype=np.int64).reshape(-1) for positives in positives_per_query]
+    indices = np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=np.int64)
+    return ends - counts, ends, indices
+
+
+def get_correct_matrix(predictions, positives_per_query):
+    """Return whether each prediction is a positive of its query.
+
+    Parameters
+    ----------
+    predictions : np.array of shape [num_queries x k], indices of the
+        predictions. Negative values (i.e. missing predictions) are never correct.
+    positives_per_query : positives.Positives or sequence of arrays, with the
+        indices of the positives of each query.
+
+    Returns
+    -------
+    correct : np.array of bool of shape [num_queries x k]
+    """
+    predictions = np.asarray(predictions, dtype=np.int64)
+    num_queries = len(predictions)
+    starts, ends, indices = _to_csr(positives_per_query)
+    counts = ends - starts
+    # Gather the (possibly non contiguous) ranges of positives of all queries
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - starts, counts)
+    positives_indices = indices[positions].astype(np.int64)
+    positives_queries = np.repeat(np.arange(num_queries), counts)
+    # Encode each (query, database index) pair as a single int64 key
+    num_keys = max(predictions.max(initial=0), positives_indices.max(initial=0)) + 1
+    positives_keys = positives_queries * num_keys + positives_indices
+    predictions_keys = np.arange(num_queries)[:, None] * num_keys + predictions
+    return np.isin(predictions_keys, positives_keys) & (predictions >= 0)
+
+
+def get_first_correct_rank(correct):
+    """Return the rank of the first correct prediction of each query, or k
+    (the number of predictions) for queries without correct predictions."""
+    return np.where(correct.any(axis=1), correct.argmax(axis=1), correct.shape[1])
+
+
+def compute_recalls(correct, recall_values):
+    """Return the recall@N (in percentages) for each N in recall_values.
+
+    Parameters
+    ----------
+    correct : np.array of bool of shape [num_queries x k], e.g. the output of
+        get_correct_matrix()
+    recall_values : list[int]
+    """
+    first_correct_rank = get_first_correct_rank(np.asarray(correct, dtype=bool))
+    return np.array([(first_correct_rank < n).mean() * 100 for n in recall_values])
+
+
+def compute_knn_recalls(predictions, exact_predictions, recall_values):
+    """Return, for each N in recall_values, the percentage of queries whose exact
+    nearest neighbour is within the first N predictions (the 1-recall@N used by
+    FAISS), to measure the accuracy of an approximate search."""
+    found = np.asarray(predictions) == np.asarray(exact_predictions)[:, :1]
+    return compute_recalls(found, recall_values)
@@ -0,0 +1,127 @@
+"""Search restricted by geographic priors: each query comes with a prior
+(UTM east, UTM north, radius in meters), and only the database images within
+the radius are searched. The database images are bucketed in a regular grid
+over their UTMs, so that finding the images near a prior only visits the
+cells which overlap it, instead of the whole database.
+"""
+
+import csv
+import os
+
+import faiss
+import numpy as np
+
+
+class UTMGrid:
+    """Regular grid of square cells of cell_size meters over the UTMs of the
+    database. The indices of the images of each cell are stored contiguously
+    (CSR-like), sorted by cell key.
+
+    Parameters
+    ----------
+    utms : np.array of shape [num_database x 2], UTM east and north
+    cell_size : float, side of the cells in meters
+    """
+
+    def __init__(self, utms, cell_size=100):
+        self.utms = np.asarray(utms, dtype=np.float64)
+        self.cell_size = cell_size
+        cells = np.floor(self.utms / cell_size).astype(np.int64)
+        keys = self._get_keys(cells[:, 0], cells[:, 1])
+        self.indices = np.argsort(keys, kind="stable")
+        self.keys, self.starts, counts = np.unique(keys[self.indices], return_index=True, return_counts=True)
+        self.ends = self.starts + counts
+
+    def __repr__(self):
+        return f"< UTMGrid; #images: {len(self.utms)}; #cells: {len(self.keys)}; cell size: {self.cell_size} m >"
+
+    @staticmethod
+    def _get_keys(cells_east, cells_north):
+        # Cells indices of UTMs are far below 2**31, so each cell gets a distinct key
+        return cells_east * 2**32 + (cells_north + 2**31)
+
+    def query(self, center, radius):
+        """Return the sorted indices of the database images within radius of center."""
+        low = np.floor((np.asarray(center) - radius) / self.cell_size).astype(np.int64)
+        high = np.floor((np.asarray(center) + radius) / self.cell_size).astype(np.int64)
+        num_cells = (high[0] - low[0] + 1) * (high[1] - low[1] + 1)
+        if num_cells >= len(self.keys):
+            # The prior is larger than the area covered by the database, checking all images is cheaper
+            candidates = np.arange(len(self.utms))
+        else:
+            cells_east, cells_north = np.meshgrid(
+                np.arange(low[0], high[0] + 1), np.arange(low[1], high[1] + 1), indexing="ij"
+            )
+            keys = self._get_keys(cells_east.reshape(-1), cells_north.reshape(-1))
+            positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            positions = positions[self.keys[positions] == keys]
+            candidates = [self.indices[start:end] for start, end in zip(self.starts[positions], self.ends[positions])]
+            candidates = np.concatenate(candidates) if len(candidates) > 0 else np.zeros(0, dtype=np.int64)
+        distances = np.linalg.norm(self.utms[candidates] - center, axis=1)
+        return np.sort(candidates[distances <= radius])
+
+
+def read_geo_priors(csv_path, queries_paths, queries_folder):
+    """Read the priors of the queries from a CSV file with rows
+    query_path,utm_east,utm_north,radius where query_path is absolute or relative
+    to queries_folder. A header row is allowed.
+
+    Returns
+    -------
+    priors : np.array of shape [num_queries x 3], with UTM east, UTM north and
+        radius of each query, NaN for queries without a prior
+    """
+    positions = {}
+    for position, path in enumerate(queries_paths):
+        positions[os.path.abspath(path)] = position
+    priors = np.full((len(queries_paths), 3), np.nan)
+    with open(csv_path, newline="") as file:
+        for row_index, row in enumerate(csv.reader(file)):
+            if len(row) == 0:
+                continue
+            try:
+                prior = [float(value) for value in row[1:4]]
+            except ValueError:
+                if row_index == 0:
+                    continue  # Header
+                raise
+            if len(prior) != 3:
+                raise ValueError(f"Rows of {csv_path} must be query_path,utm_east,utm_north,radius, not {row}")
+            path = row[0] if os.path.isabs(row[0]) else os.path.join(queries_folder, row[0])
+            if os.path.abspath(path) not in positions:
+                raise ValueError(f"Query {row[0]} of {csv_path} is not within {queries_folder}")
+            priors[positions[os.path.abspath(path)]] = prior
+    return priors
+
+
+def geo_prior_search(queries_descriptors, database_descriptors, k, grid, priors, search_fn):
+    """Search the k nearest neighbours of each query only within the database
+    images within its prior. Queries without a prior (NaN) are searched with
+    search_fn(queries_descriptors, k) over the whole database.
+
+    Returns
+    -------
+    distances : np.array of float32 of shape [num_queries x k], inf for missing
+        predictions, when less than k images are within the prior
+    predictions : np.array of int64 of shape [num_queries x k], -1 for missing predictions
+    num_candidates : np.array of shape [num_queries], number of images searched for each query
+    """
+    num_queries = len(queries_descriptors)
+    distances = np.full((num_queries, k), np.inf, dtype="float32")
+    predictions = np.full((num_queries, k), -1, dtype="int64")
+    num_candidates = np.full(num_queries, len(database_descriptors))
+    has_prior = np.isfinite(priors).all(axis=1)
+    if not has_prior.all():
+        distances[~has_prior], predictions[~has_prior] = search_fn(queries_descriptors[~has_prior], k)
+    for query_index in np.nonzero(has_prior)[0]:
+        candidates = grid.query(priors[query_index, :2], priors[query_index, 2])
+        num_candidates[query_index] = len(candidates)
+        if len(candidates) == 0:
+            continue
+        query = np.ascontiguousarray(queries_descriptors[query_index : query_index + 1], dtype="float32")
+        candidates_descriptors = np.ascontiguousarray(database_descriptors[candidates], dtype="float32")
+        num_predictions = min(k, len(candidates))
+        query_distances, query_predictions = faiss.knn(query, candidates_descriptors, num_predictions)
+        distances[query_index, :num_predictions] = query_distances[0]
+        predictions[query_index, :num_predictions] = candidates[query_predictions[0]]
+    return distances, predictions, num_candidates
@@ -0,0 +1,204 @@
+"""Cache of pre-decoded and resized images, stored as raw uint8 arrays in a few
+large shard files with an offset index, similarly to dirtorch's deploy().
+Reading images from a few big memory-mappable files is much faster than
+opening and decoding many small JPEGs, especially on network filesystems.
+
+A cache can be built in advance with
+    python image_shards.py --images_folder path/to/database --shards_dir path/to/shards --image_size 512 512 --fast_decode
+or it is built automatically the first time main.py is run with --image_shards_dir.
+With --fast_decode images are stored already resized, decoded as with main.py's
+--fast_decode. Otherwise they are stored at their original resolution, and resized
+when they are read, so that they are exactly the same images as without shards.
+Shards hold raw pixels, so at the original resolution they usually take 10-20x the
+disk space of the JPEGs.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from test_dataset import decode_resized_image, get_resized_size, read_images_paths
+
+SHARD_SIZE = 2**30  # Maximum size in bytes of a shard file
+
+
+def get_shards_folder(shards_dir, images_folder, image_size=None, size_multiple=None, fast_decode=True):
+    """Return the folder of the shards of images_folder decoded and resized with the given parameters."""
+    if not fast_decode:
+        # Images are stored at their original resolution, so the shards don't depend on the resizing
+        image_size, size_multiple = None, None
+    config = {
+        "images_folder": os.path.abspath(images_folder),
+        "image_size": image_size,
+        "size_multiple": size_multiple,
+        "fast_decode": fast_decode,
+    }
+    config_hash = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+    return Path(shards_dir) / f"{Path(images_folder).name}_{config_hash}"
+
+
+def estimate_shards_size(images_paths, num_samples=100):
+    """Return the estimated size in bytes of the shards of images_paths stored at their
+    original resolution, from the headers of up to num_samples evenly spaced images."""
+    if len(images_paths) == 0:
+        return 0
+    sample_indices = np.linspace(0, len(images_paths) - 1, min(num_samples, len(images_paths))).astype(int)
+    sample_nbytes = []
+    for i in sample_indices:
+        with Image.open(images_paths[i]) as pil_img:
+            sample_nbytes.append(pil_img.size[0] * pil_img.size[1] * 3)
+    return int(np.mean(sample_nbytes) * len(images_paths))
+
+
+def build_image_shards(
+    images_paths,
+    shards_folder,
+    image_size=None,
+    size_multiple=None,
+    fast_decode=True,
+    num_threads=8,
+    shard_size=SHARD_SIZE,
+):
+    """Decode and resize all images, and write them in shard files within shards_folder.
+
+    Parameters
+    ----------
+    images_paths : list[str], paths of the images to store
+    shards_folder : Path, folder where shards are written
+    image_size : list[int], resizing shape for images, as in TestDataset
+    size_multiple : int, as in TestDataset
+    fast_decode : bool, if True images are decoded and resized as with TestDataset's
+        fast_decode, otherwise they are stored at their original resolution
+    num_threads : int, number of threads used to decode images
+    shard_size : int, maximum size in bytes of a shard file
+    """
+
+    def load_image(image_path):
+        pil_img = Image.open(image_path)
+        if not fast_decode:
+            return np.asarray(pil_img.convert("RGB"))
+        image_hw = get_resized_size(*pil_img.size, image_size, size_multiple)
+        return np.asarray(decode_resized_image(pil_img, image_hw))
+
+    if not fast_decode:
+        # Raw pixels at the original resolution take much more space than the JPEGs they come from
+        jpegs_size = sum(os.path.getsize(path) for path in images_paths)
+        print(
+            f"WARNING: building shards of {len(images_paths)} images at their original resolution, which will take "
+            f"about {estimate_shards_size(images_paths) / 2**30:.2f} GB on disk (the images take "
+            f"{jpegs_size / 2**30:.2f} GB). Use --fast_decode to store them resized"
+        )
+    shards_folder = Path(shards_folder)
+    shards_folder.mkdir(parents=True, exist_ok=True)
+    (shards_folder / "index.npy").unlink(missing_ok=True)
+    # Each row of the index is (shard number, offset within the shard, H, W)
+    index = np.empty((len(images_paths), 4), dtype=np.int64)
+    shard_num, offset = 0, 0
+    shard_file = open(shards_folder / f"shard_{shard_num:05d}.bin", "wb")
+    with ThreadPoolExecutor(num_threads) as executor:
+        images = executor.map(load_image, images_paths)
+        for i, image in enumerate(tqdm(images, total=len(images_paths), desc=f"Building shards in {shards_folder}")):
+            if offset > 0 and offset + image.nbytes > shard_size:
+                shard_file.close()
+                shard_num, offset = shard_num + 1, 0
+                shard_file = open(shards_folder / f"shard_{shard_num:05d}.bin", "wb")
+            shard_file.write(image.tobytes())
+            index[i] = shard_num, offset, image.shape[0], image.shape[1]
+            offset += image.nbytes
+    shard_file.close()
+
+    with open(shards_folder / "images_paths.txt", "w") as file:
+        file.write("\n".join(images_paths))
+    # The index is written last, so that its existence means that the shards are complete
+    np.save(shards_folder / "index.npy", index)
+
+
+class ImageShards:
+    """Read-only access to the images stored by build_image_shards().
+
+    Shard files are memory-mapped lazily, so that the object can be safely
+    pickled and sent to the DataLoader workers.
+    """
+
+    def __init__(self, shards_folder):
+        self.shards_folder = Path(shards_folder)
+        self.index = np.load(self.shards_folder / "index.npy")
+        with open(self.shards_folder / "images_paths.txt", "r") as file:
+            self.images_paths = file.read().splitlines()
+        self._shards = {}
+
+    @staticmethod
+    def exists(shards_folder):
+        return (Path(shards_folder) / "index.npy").exists()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def get_image_size(self, index):
+        """Return the (H, W) of the image at 'index'."""
+        return tuple(self.index[index, 2:].tolist())
+
+    def __getitem__(self, index):
+        """Return the image at 'index' as a uint8 np.array of shape (H, W, 3)."""
+        shard_num, offset, h, w = self.index[index].tolist()
+        if shard_num not in self._shards:
+            self._shards[shard_num] = np.memmap(
+                self.shards_folder / f"shard_{shard_num:05d}.bin", dtype=np.uint8, mode="r"
+            )
+        return np.array(self._shards[shard_num][offset : offset + h * w * 3]).reshape(h, w, 3)
+
+
+def get_image_shards(shards_dir, images_folder, images_paths, image_size=None, size_multiple=None, fast_decode=True):
+    """Return the ImageShards of images_folder, building them if they don't exist yet."""
+    shards_folder = get_shards_folder(shards_dir, images_folder, image_size, size_multiple, fast_decode)
+    if ImageShards.exists(shards_folder):
+        image_shards = ImageShards(shards_folder)
+        if image_shards.images_paths == list(images_paths):
+            print(f"Reading images of {images_folder} from the shards in {shards_folder}")
+            return image_shards
+        print(f"The images within {images_folder} changed, rebuilding the shards in {shards_folder}")
+    build_image_shards(images_paths, shards_folder, image_size, size_multiple, fast_decode)
+    return ImageShards(shards_folder)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--images_folder", type=str, required=True, help="path/to/images")
+    parser.add_argument("--shards_dir", type=str, required=True, help="folder where the shards are saved")
+    parser.add_argument(
+        "--image_size",
+        type=int,
+        default=None,
+        nargs="+",
+        help="Resizing shape for images (HxW), same as in main.py",
+    )
+    parser.add_argument(
+        "--size_multiple", type=int, default=None, help="set to 14 for models wrapped by ResizingWrapper (DINOv2)"
+    )
+    parser.add_argument(
+        "--fast_decode",
+        action="store_true",
+        help="store the images resized, decoded as with main.py's --fast_decode. Without it images are stored "
+        "at their original resolution, for runs of main.py without --fast_decode",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    images_paths = read_images_paths(args.images_folder)
+    get_image_shards(
+        args.shards_dir, args.images_folder, images_paths, args.image_size, args.size_multiple, args.fast_decode
+    )
@@ -0,0 +1,135 @@
+"""Fast indexing of the images within a dataset folder.
+
+Running
+    python images_index.py --dataset_folder path/to/database
+writes the file path/to/database_images_paths.txt, which read_images_paths()
+reads instead of scanning the folder, and the sidecar file
+path/to/database_images_index.npz, with the UTM coordinates (and all the
+other @-separated fields) parsed from the images paths, so that TestDataset
+doesn't need to parse them at every run.
+"""
+
+import argparse
+import hashlib
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+IMAGES_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def _scan_dir(dir_path):
+    """Return the image files and the subdirectories within dir_path."""
+    files, subdirs = [], []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            # Skip hidden files and folders, like glob() does
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGES_EXTENSIONS:
+                files.append(entry.path)
+    return files, subdirs
+
+
+def scan_images_paths(dataset_folder, num_threads=16):
+    """Find images within dataset_folder with a parallel os.scandir() walk,
+    which is much faster than glob() on large (or network) folders.
+
+    Returns
+    -------
+    images_paths : list[str], sorted paths of images within dataset_folder
+    """
+    images_paths = []
+    with ThreadPoolExecutor(num_threads) as executor:
+        pending = {executor.submit(_scan_dir, dataset_folder)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                images_paths.extend(files)
+                pending.update(executor.submit(_scan_dir, subdir) for subdir in subdirs)
+    return sorted(images_paths)
+
+
+def parse_images_fields(images_paths):
+    """Parse the @-separated fields of images paths, which have format
+    path/to/file/@utm_east@utm_north@...@.jpg
+
+    Returns
+    -------
+    utms : np.array of shape [num_images x 2], NaN for unparsable paths
+    fields : np.array of str of shape [num_images x num_fields], where
+        fields[:, 0] and fields[:, 1] are the UTM east and north
+    """
+    splits = [path.split("@")[1:-1] for path in images_paths]
+    num_fields = max((len(split) for split in splits), default=0)
+    fields = np.array([split + [""] * (num_fields - len(split)) for split in splits], dtype=str)
+    fields = fields.reshape(len(images_paths), num_fields)
+    utms = np.full((len(images_paths), 2), np.nan)
+    for i, split in enumerate(splits):
+        try:
+            utms[i] = float(split[0]), float(split[1])
+        except (IndexError, ValueError):
+            pass
+    return utms, fields
+
+
+def get_paths_hash(dataset_folder, images_paths):
+    """Return a hash of the paths of images relative to dataset_folder, which
+    identifies the images that an index was built from."""
+    prefix = dataset_folder.rstrip("/") + "/"
+    hasher = hashlib.sha1()
+    for path in images_paths:
+        # Paths read from dataset_folder_images_paths.txt are joined with an extra "/" if dataset_folder ends with one
+        relative_path = path[len(prefix) :].lstrip("/") if path.startswith(prefix) else os.path.relpath(path, prefix)
+        hasher.update(relative_path.replace(os.sep, "/").encode() + b"\n")
+    return hasher.hexdigest()
+
+
+def build_images_index(dataset_folder, num_threads=16):
+    """Write dataset_folder_images_paths.txt and dataset_folder_images_index.npz."""
+    dataset_folder = dataset_folder.rstrip("/")
+    images_paths = scan_images_paths(dataset_folder, num_threads)
+    if len(images_paths) == 0:
+        raise FileNotFoundError(f"Directory {dataset_folder} does not contain any images")
+    relative_paths = [os.path.relpath(path, dataset_folder).replace(os.sep, "/") for path in images_paths]
+    utms, fields = parse_images_fields(relative_paths)
+    with open(dataset_folder + "_images_paths.txt", "w") as file:
+        file.write("\n".join(relative_paths))
+    paths_hash = get_paths_hash(dataset_folder, images_paths)
+    np.savez(dataset_folder + "_images_index.npz", utms=utms, fields=fields, paths_hash=paths_hash)
+    print(f"Indexed {len(images_paths)} images within {dataset_folder}")
+
+
+def read_images_utms(dataset_folder, images_paths):
+    """Read the UTMs from dataset_folder_images_index.npz if it exists and was
+    built from exactly images_paths, otherwise return None."""
+    index_path = dataset_folder.rstrip("/") + "_images_index.npz"
+    if not os.path.exists(index_path):
+        return None
+    with np.load(index_path) as index:
+        utms = index["utms"]
+        # Indexes written without the hash of the paths can't be checked, and are not used
+        paths_hash = str(index["paths_hash"]) if "paths_hash" in index else None
+    if len(utms) != len(images_paths) or np.isnan(utms).any():
+        return None
+    if paths_hash != get_paths_hash(dataset_folder, images_paths):
+        print(f"The images within {dataset_folder} changed since {index_path} was written, it is not used")
+        return None
+    return utms
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--dataset_folder", type=str, nargs="+", required=True, help="path/to/images")
+    parser.add_argument("--num_threads", type=int, default=16, help="_")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    for dataset_folder in args.dataset_folder:
+        build_images_index(dataset_folder, args.num_threads)
@@ -0,0 +1,84 @@
+"""Construction, persistence and querying of FAISS indexes built with
+faiss.index_factory, e.g. "Flat", "IVF4096,Flat", "IVF4096,PQ64", "HNSW32",
+"SQ8" or "PCA256,IVF1024,Flat" (see the FAISS wiki for the full syntax).
+"""
+
+import json
+import os
+import time
+
+import faiss
+import numpy as np
+
+
+def sample_descriptors(database_descriptors, sample_size, seed=0):
+    """Return a random sample of sample_size descriptors (all of them if there
+    are fewer), as a contiguous float32 array to train FAISS indexes or transforms."""
+    num_database = len(database_descriptors)
+    if num_database > sample_size:
+        # Sorted indices make reads from a memmap sequential
+        sample_indices = np.sort(np.random.default_rng(seed).choice(num_database, sample_size, replace=False))
+        samples = database_descriptors[sample_indices]
+    else:
+        samples = database_descriptors[:]
+    return np.ascontiguousarray(samples, dtype="float32")
+
+
+def build_index(database_descriptors, index_factory="Flat", train_size=100000, chunk_size=100000, seed=0):
+    """Build a FAISS index over database_descriptors, training it on a random
+    sample of train_size descriptors if needed. Descriptors are added in chunks,
+    so that database_descriptors can be a np.memmap larger than RAM.
+    """
+    num_database, dim = database_descriptors.shape
+    index = faiss.index_factory(dim, index_factory, faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(sample_descriptors(database_descriptors, train_size, seed))
+    for start in range(0, num_database, chunk_size):
+        index.add(np.ascontiguousarray(database_descriptors[start : start + chunk_size], dtype="float32"))
+    return index
+
+
+def set_search_parameters(index, nprobe=None, ef_search=None):
+    """Set the search-time parameters of IVF (nprobe) and HNSW (efSearch) indexes."""
+    parameter_space = faiss.ParameterSpace()
+    if nprobe is not None:
+        parameter_space.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search is not None:
+        parameter_space.set_index_parameter(index, "efSearch", ef_search)
+
+
+def load_or_build_index(index_path, database_descriptors, index_factory="Flat", train_size=100000):
+    """Read the index from index_path if it exists and was built with the same
+    index_factory and train_size over as many descriptors of the same dimension,
+    otherwise build it and write it to index_path. The configuration of the
+    index is saved next to it, in index_path + ".json".
+
+    Returns
+    -------
+    index : faiss.Index
+    loaded : bool, True if the index was read from index_path
+    """
+    num_database, dim = database_descriptors.shape
+    config = {"index_factory": index_factory, "train_size": train_size, "ntotal": num_database, "d": dim}
+    config_path = f"{index_path}.json"
+    if os.path.exists(index_path) and os.path.exists(config_path):
+        with open(config_path, "r") as file:
+            saved_config = json.load(file)
+        if saved_config == config:
+            return faiss.read_index(str(index_path)), True
+    index = build_index(database_descriptors, index_factory, train_size)
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    faiss.write_index(index, str(index_path))
+    # Written after the index, so that an interrupted write is never reused
+    with open(config_path, "w") as file:
+        json.dump(config, file, indent=2)
+    return index, False
+
+
+def timed_search(search_fn, queries_descriptors, k):
+    """Run search_fn(queries_descriptors, k), and return its output together
+    with the latency in milliseconds per query."""
+    start_time = time.perf_counter()
+    distances, predictions = search_fn(queries_descriptors, k)
+    latency_ms = (time.perf_counter() - start_time) * 1000 / max(len(queries_descriptors), 1)
+    return distances, predictions, latency_ms
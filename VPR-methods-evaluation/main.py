@@ -1,19 +1,206 @@
+import os
 import parser
 import sys
+from functools import partial
 from datetime import datetime
 from pathlib import Path
 
 import numpy as np
 import torch
-import faiss
 from loguru import logger
 from torch.utils.data import DataLoader
-from torch.utils.data.dataset import Subset
 from tqdm import tqdm
 
 import visualizations
 import vpr_models
-from test_dataset import TestDataset
+from descriptors_cache import DescriptorsCache, get_model_hash
+from database_store import DatabaseStore
+from descriptors_io import get_descriptors_path, save_descriptors
+from geo_search import UTMGrid, geo_prior_search, read_geo_priors
+from evaluation import compute_knn_recalls, compute_recalls, get_correct_matrix
+from indexes import load_or_build_index, set_search_parameters, timed_search
+from query_expansion import expand_descriptors, remove_self_matches
+from search import chunked_search
+from sharded_index import ShardedIndex
+from test_dataset import BucketBatchSampler, TestDataset
+from tta import TTADataset, collate_views, pool_descriptors
+from whitening import apply_pca_whitening, load_or_fit_pca_whitening
+
+
+def load_model(args):
+    """Load the model. With --fast_decode, if the model has a fixed input size and --image_size
+    is not set, set args.image_size to it, so that images are resized only once, while decoding.
+    Without --fast_decode images are resized as usual, and then by the model itself."""
+    model = vpr_models.get_model(args.method, args.backbone, args.descriptors_dimension)
+    model = model.eval().to(args.device)
+    input_size = getattr(model, "input_size", None)
+    if input_size is not None and args.fast_decode and args.image_size != list(input_size):
+        if args.image_size is None:
+            logger.info(f"{args.method} takes images of size {input_size}, images will be directly resized to it")
+            args.image_size = list(input_size)
+        else:
+            logger.warning(
+                f"{args.method} takes images of size {input_size}, so images resized to --image_size "
+                f"{args.image_size} will be resized again by the model"
+            )
+    return model
+
+
+def get_size_multiple(model, args):
+    """Return the multiple to which the dataloader rounds the images sizes, for models which take
+    images with sizes multiple of it (e.g. 14 for DINOv2). Without --fast_decode it is only used
+    when images are not resized, as then it gives the same images as the resize within the model."""
+    if args.fast_decode or not args.image_size:
+        return getattr(model, "input_size_multiple", None)
+    return None
+
+
+def get_model_config(model, args):
+    """Return the configuration which identifies the descriptors extracted by model with the given args."""
+    return {
+        "method": args.method,
+        "backbone": args.backbone,
+        "descriptors_dimension": args.descriptors_dimension,
+        "image_size": args.image_size,
+        "fast_decode": args.fast_decode,
+        "model_hash": get_model_hash(model),
+        # Only set with TTA, so that the cache of descriptors extracted without TTA is still valid
+        **({"tta": [args.tta_scales, args.tta_flip, args.tta_pool]} if args.use_tta else {}),
+    }
+
+
+def get_descriptors_cache(model, args):
+    """Return the DescriptorsCache of the descriptors extracted by model with the given args."""
+    return DescriptorsCache(args.descriptors_cache_dir, get_model_config(model, args))
+
+
+def update_database_store(model, test_ds, args):
+    """Open the --database_store and synchronize it with the database of test_ds:
+    extract and add the descriptors of the new images, and tombstone the removed ones."""
+    database_store = DatabaseStore(
+        args.database_store, get_model_config(model, args), args.faiss_index, args.faiss_train_size
+    )
+    new_indices, removed_ids = database_store.get_changes(test_ds.database_paths)
+    logger.info(f"Using {database_store}, adding {len(new_indices)} images and removing {len(removed_ids)}")
+    new_descriptors = np.empty((len(new_indices), args.descriptors_dimension), dtype="float32")
+    extract_descriptors(model, test_ds, new_indices, new_descriptors, None, args)
+    database_store.add([test_ds.database_paths[i] for i in new_indices], new_descriptors)
+    database_store.remove(removed_ids)
+    if args.compact_database_store:
+        database_store.compact()
+        logger.info(f"Compacted the store: {database_store}")
+    database_store.save()
+    return database_store
+
+
+def extract_descriptors(model, test_ds, indices, out_descriptors, offset, args):
+    """Extract the descriptors of the images of test_ds at the given indices,
+    and write them in the rows (indices - offset) of out_descriptors. If offset
+    is None, indices must be sorted and out_descriptors has a row per index."""
+    if len(indices) == 0:
+        return
+    sorted_indices = np.asarray(indices)
+    sampler = BucketBatchSampler(test_ds, indices, args.batch_size)
+    logger.debug(f"Images grouped in {sampler.num_buckets} buckets of same resolution")
+    if args.use_tta:
+        # All the views of an image are generated in the worker that decodes it, and collated per scale
+        tta_ds = TTADataset(test_ds, args.tta_scales, args.tta_flip, test_ds.size_multiple)
+        collate_fn = partial(collate_views, num_views_per_scale=tta_ds.num_views_per_scale)
+        dataloader = DataLoader(tta_ds, num_workers=args.num_workers, batch_sampler=sampler, collate_fn=collate_fn)
+    else:
+        dataloader = DataLoader(dataset=test_ds, num_workers=args.num_workers, batch_sampler=sampler)
+    with torch.inference_mode():
+        for images, indices in tqdm(dataloader):
+            if args.use_tta:
+                # Descriptors of shape [num_views x batch_size x dim]
+                views_descriptors = [
+                    model(views.to(args.device)).reshape(-1, len(indices), out_descriptors.shape[1]) for views in images
+                ]
+                descriptors = pool_descriptors(torch.cat(views_descriptors), args.tta_pool)
+            else:
+                descriptors = model(images.to(args.device))
+            descriptors = descriptors.cpu().numpy()
+            if offset is None:
+                out_descriptors[np.searchsorted(sorted_indices, indices.numpy()), :] = descriptors
+            else:
+                out_descriptors[indices.numpy() - offset, :] = descriptors
+
+
+def get_recalls_str(recalls, recall_values):
+    return ", ".join([f"R@{val}: {rec:.1f}" for val, rec in zip(recall_values, recalls)])
+
+
+def find_predictions(
+    database_descriptors, queries_descriptors, index_path, args, geo_priors=None, database_utms=None, k=None
+):
+    """Search the k (by default max(recall_values)) nearest neighbours of each
+    query, with an exhaustive search or with the index built by --faiss_index.
+    If geo_priors is set, each query is only searched within the database images
+    within its prior."""
+    k = k or max(args.recall_values)
+    sharded_index = None
+    if args.num_index_shards > 1 and (index_path is None or args.faiss_exact_baseline):
+        sharded_index = ShardedIndex(
+            database_descriptors, args.num_index_shards, args.search_memory_mb, args.search_num_threads
+        )
+        logger.debug(f"Database split in {args.num_index_shards} shards, each searched by a separate process")
+
+    def exact_search(queries_descriptors, k):
+        if sharded_index is not None:
+            return sharded_index.search(queries_descriptors, k)
+        # Search directly over the (possibly memory-mapped) database, without copying it into an index
+        return chunked_search(
+            queries_descriptors, database_descriptors, k, args.search_memory_mb, args.search_num_threads
+        )
+
+    try:
+        if geo_priors is not None:
+            grid = UTMGrid(database_utms, args.geo_grid_cell_size)
+            logger.debug(f"Built {grid}")
+            num_candidates = []
+
+            def geo_search(queries_descriptors, k):
+                distances, predictions, candidates = geo_prior_search(
+                    queries_descriptors, database_descriptors, k, grid, geo_priors, exact_search
+                )
+                num_candidates.append(candidates)
+                return distances, predictions
+
+            distances, predictions, latency_ms = timed_search(geo_search, queries_descriptors, k)
+            logger.info(
+                f"Search within the geographic priors took {latency_ms:.3f} ms per query, "
+                f"with {num_candidates[0].mean():.1f} database images searched per query on average"
+            )
+            return distances, predictions
+
+        if index_path is None:
+            distances, predictions, latency_ms = timed_search(exact_search, queries_descriptors, k)
+            logger.debug(f"Exhaustive search took {latency_ms:.3f} ms per query")
+            return distances, predictions
+
+        faiss_index, loaded = load_or_build_index(
+            index_path, database_descriptors, args.faiss_index, args.faiss_train_size
+        )
+        logger.info(
+            f"{'Loaded' if loaded else 'Built and saved'} {args.faiss_index} index in {index_path} "
+            f"({os.path.getsize(index_path) / 2**20:.1f} MB)"
+        )
+        set_search_parameters(faiss_index, args.faiss_nprobe, args.faiss_ef_search)
+        distances, predictions, latency_ms = timed_search(faiss_index.search, queries_descriptors, k)
+        logger.info(f"Search with {args.faiss_index} index took {latency_ms:.3f} ms per query")
+
+        if args.faiss_exact_baseline:
+            _, exact_predictions, exact_latency_ms = timed_search(exact_search, queries_descriptors, k)
+            knn_recalls = compute_knn_recalls(predictions, exact_predictions, args.recall_values)
+            knn_recalls_str = get_recalls_str(knn_recalls, args.recall_values)
+            logger.info(
+                f"Exhaustive search took {exact_latency_ms:.3f} ms per query. "
+                f"Recalls of the exact nearest neighbour with {args.faiss_index}: {knn_recalls_str}"
+            )
+        return distances, predictions
+    finally:
+        if sharded_index is not None:
+            sharded_index.close()
 
 
 def main(args):
@@ -31,8 +218,7 @@ def main(args):
     )
     logger.info(f"The outputs are being saved in {log_dir}")
 
-    model = vpr_models.get_model(args.method, args.backbone, args.descriptors_dimension)
-    model = model.eval().to(args.device)
+    model = load_model(args)
 
     test_ds = TestDataset(
         args.database_folder,
@@ -40,61 +226,218 @@ def main(args):
         positive_dist_threshold=args.positive_dist_threshold,
         image_size=args.image_size,
         use_labels=args.use_labels,
+        size_multiple=get_size_multiple(model, args),
+        fast_decode=args.fast_decode,
+        image_shards_dir=args.image_shards_dir,
+        positives_cache_dir=args.positives_cache_dir,
     )
     logger.info(f"Testing on {test_ds}")
 
-    with torch.inference_mode():
-        logger.debug("Extracting database descriptors for evaluation/testing")
-        database_subset_ds = Subset(test_ds, list(range(test_ds.num_database)))
-        database_dataloader = DataLoader(
-            dataset=database_subset_ds, num_workers=args.num_workers, batch_size=args.batch_size
+    database_indices = list(range(test_ds.num_database))
+    queries_indices = list(range(test_ds.num_database, test_ds.num_database + test_ds.num_queries))
+    num_database_descriptors = test_ds.num_database
+    if args.database_store:
+        # Only the descriptors of new database images are extracted, and they are kept within the store
+        database_store = update_database_store(model, test_ds, args)
+        database_indices, num_database_descriptors = [], 0
+    if args.descriptors_memmap:
+        # Descriptors are written batch by batch into .npy files, so that they never need to fit in RAM
+        logger.info(f"Writing the descriptors into memory-mapped files in {log_dir}")
+        database_descriptors = np.lib.format.open_memmap(
+            log_dir / "database_descriptors.npy",
+            mode="w+",
+            dtype="float32",
+            shape=(num_database_descriptors, args.descriptors_dimension),
         )
-        all_descriptors = np.empty((len(test_ds), args.descriptors_dimension), dtype="float32")
-        for images, indices in tqdm(database_dataloader):
-            descriptors = model(images.to(args.device))
-            descriptors = descriptors.cpu().numpy()
-            all_descriptors[indices.numpy(), :] = descriptors
+        queries_descriptors = np.lib.format.open_memmap(
+            log_dir / "queries_descriptors.npy",
+            mode="w+",
+            dtype="float32",
+            shape=(test_ds.num_queries, args.descriptors_dimension),
+        )
+    else:
+        database_descriptors = np.empty((num_database_descriptors, args.descriptors_dimension), dtype="float32")
+        queries_descriptors = np.empty((test_ds.num_queries, args.descriptors_dimension), dtype="float32")
 
-        logger.debug("Extracting queries descriptors for evaluation/testing using batch size 1")
-        queries_subset_ds = Subset(
-            test_ds, list(range(test_ds.num_database, test_ds.num_database + test_ds.num_queries))
+    if args.descriptors_cache_dir:
+        descriptors_cache = get_descriptors_cache(model, args)
+        logger.info(f"Using {descriptors_cache}")
+        if not args.database_store:
+            database_indices = descriptors_cache.read(test_ds.database_paths, database_descriptors)
+        queries_indices = [
+            i + test_ds.num_database for i in descriptors_cache.read(test_ds.queries_paths, queries_descriptors)
+        ]
+        logger.info(
+            f"Found {num_database_descriptors + test_ds.num_queries - len(database_indices) - len(queries_indices)} "
+            "cached descriptors, extracting "
+            f"{len(database_indices)} database and {len(queries_indices)} queries descriptors"
+        )
+
+    logger.debug("Extracting database descriptors for evaluation/testing")
+    extract_descriptors(model, test_ds, database_indices, database_descriptors, 0, args)
+    if args.descriptors_cache_dir:
+        descriptors_cache.write(
+            [test_ds.images_paths[i] for i in database_indices], database_descriptors[database_indices]
         )
-        queries_dataloader = DataLoader(dataset=queries_subset_ds, num_workers=args.num_workers, batch_size=1)
-        for images, indices in tqdm(queries_dataloader):
-            descriptors = model(images.to(args.device))
-            descriptors = descriptors.cpu().numpy()
-            all_descriptors[indices.numpy(), :] = descriptors
 
-    queries_descriptors = all_descriptors[test_ds.num_database :]
-    database_descriptors = all_descriptors[: test_ds.num_database]
+    logger.debug("Extracting queries descriptors for evaluation/testing")
+    extract_descriptors(model, test_ds, queries_indices, queries_descriptors, test_ds.num_database, args)
+    if args.descriptors_cache_dir:
+        descriptors_cache.write(
+            [test_ds.images_paths[i] for i in queries_indices],
+            queries_descriptors[np.array(queries_indices, dtype=int) - test_ds.num_database],
+        )
 
-    if args.save_descriptors:
-        logger.info(f"Saving the descriptors in {log_dir}")
-        np.save(log_dir / "queries_descriptors.npy", queries_descriptors)
-        np.save(log_dir / "database_descriptors.npy", database_descriptors)
+    if args.descriptors_memmap:
+        database_descriptors.flush()
+        queries_descriptors.flush()
+    # Memory-mapped float32 descriptors are already saved in the log dir
+    if args.save_descriptors and not (args.descriptors_memmap and args.descriptors_format == "float32"):
+        logger.info(f"Saving the descriptors in {log_dir} as {args.descriptors_format}")
+        queries_path = get_descriptors_path(log_dir, "queries_descriptors", args.descriptors_format)
+        database_path = get_descriptors_path(log_dir, "database_descriptors", args.descriptors_format)
+        save_descriptors(queries_path, queries_descriptors, args.descriptors_format)
+        save_descriptors(database_path, database_descriptors, args.descriptors_format)
 
-    # Use a kNN to find predictions
-    faiss_index = faiss.IndexFlatL2(args.descriptors_dimension)
-    faiss_index.add(database_descriptors)
-    del database_descriptors, all_descriptors
+    baseline_predictions = None
+    if args.pca_dim is not None:
+        pca_path = args.pca_path
+        if pca_path is None:
+            if args.descriptors_cache_dir:
+                database_fingerprint = descriptors_cache.get_fingerprint(test_ds.database_paths)
+                pca_name = f"pca_{args.pca_dim}_{args.pca_train_size}_{database_fingerprint}.faiss"
+                pca_path = descriptors_cache.folder / pca_name
+            else:
+                pca_path = log_dir / "pca_whitening.faiss"
+        pca, loaded = load_or_fit_pca_whitening(pca_path, database_descriptors, args.pca_dim, args.pca_train_size)
+        logger.info(
+            f"{'Loaded' if loaded else 'Fitted and saved'} PCA-whitening from {args.descriptors_dimension} "
+            f"to {args.pca_dim} dimensions in {pca_path}"
+        )
+        logger.debug("Searching with the descriptors before PCA-whitening, as a baseline")
+        _, baseline_predictions = find_predictions(database_descriptors, queries_descriptors, None, args)
+        database_descriptors = apply_pca_whitening(pca, database_descriptors)
+        queries_descriptors = apply_pca_whitening(pca, queries_descriptors)
 
     logger.debug("Calculating recalls")
-    distances, predictions = faiss_index.search(queries_descriptors, max(args.recall_values))
+    index_path = args.faiss_index_path
+    if index_path is None and args.faiss_index != "Flat":
+        if args.descriptors_cache_dir:
+            # Save the index next to the cached descriptors, so that later runs can reuse it
+            index_name = "".join(c if c.isalnum() else "_" for c in args.faiss_index)
+            if args.pca_dim is not None:
+                index_name = f"pca_{args.pca_dim}_{args.pca_train_size}_{index_name}"
+            database_fingerprint = descriptors_cache.get_fingerprint(test_ds.database_paths)
+            index_path = descriptors_cache.folder / f"index_{index_name}_{database_fingerprint}.faiss"
+        else:
+            index_path = log_dir / "database_index.faiss"
+            logger.info(
+                f"The {args.faiss_index} index is saved in the log dir and is not reused by later runs, "
+                "set --faiss_index_path or --descriptors_cache_dir to reuse it"
+            )
+    geo_priors = None
+    if args.geo_priors is not None:
+        geo_priors = read_geo_priors(args.geo_priors, test_ds.queries_paths, args.queries_folder)
+        logger.info(f"Read the geographic priors of {np.isfinite(geo_priors).all(axis=1).sum()} queries")
+    elif args.geo_prior_radius is not None:
+        # Priors centered on the queries' own UTMs, to simulate a coarse GPS
+        geo_priors = np.column_stack([test_ds.queries_utms, np.full(test_ds.num_queries, args.geo_prior_radius)])
+    if args.database_store:
+        if database_store.index is not None:
+            # The store wraps its index in an IndexIDMap2, whose search parameters are those of the inner index
+            set_search_parameters(database_store.index.index, args.faiss_nprobe, args.faiss_ef_search)
+        distances, store_ids = database_store.search(queries_descriptors, max(args.recall_values))
+        # Map the ids within the store to the indices of the database images of test_ds
+        database_indices_per_id = np.full(len(database_store.paths), -1, dtype=np.int64)
+        database_indices_per_id[database_store.get_ids(test_ds.database_paths)] = np.arange(test_ds.num_database)
+        predictions = np.where(store_ids >= 0, database_indices_per_id[store_ids], -1)
+    else:
+        distances, predictions = find_predictions(
+            database_descriptors,
+            queries_descriptors,
+            index_path,
+            args,
+            geo_priors,
+            test_ds.database_utms if geo_priors is not None else None,
+        )
+
+    if args.dba_n or args.qe_n:
+        initial_predictions = predictions
+        if args.dba_n:
+            logger.debug(f"Database-side augmentation with the {args.dba_n} nearest neighbours of each database image")
+            database_distances, database_predictions = find_predictions(
+                database_descriptors, database_descriptors, None, args, k=args.dba_n + 1
+            )
+            database_distances, database_predictions = remove_self_matches(
+                database_distances, database_predictions, args.dba_n
+            )
+            if args.descriptors_memmap:
+                augmented_descriptors = np.lib.format.open_memmap(
+                    log_dir / "database_descriptors_dba.npy",
+                    mode="w+",
+                    dtype="float32",
+                    shape=database_descriptors.shape,
+                )
+            else:
+                augmented_descriptors = np.empty(database_descriptors.shape, dtype="float32")
+            database_descriptors = expand_descriptors(
+                database_descriptors,
+                database_descriptors,
+                database_distances,
+                database_predictions,
+                args.qe_alpha,
+                out=augmented_descriptors,
+            )
+        if args.qe_n:
+            logger.debug(f"Alpha query expansion with the {args.qe_n} first predictions of each query")
+            queries_descriptors = expand_descriptors(
+                queries_descriptors,
+                database_descriptors,
+                distances[:, : args.qe_n],
+                predictions[:, : args.qe_n],
+                args.qe_alpha,
+            )
+        # The index was built on the database before augmentation, so it can only be reused for query expansion
+        distances, predictions = find_predictions(
+            database_descriptors,
+            queries_descriptors,
+            None if args.dba_n else index_path,
+            args,
+            geo_priors,
+            test_ds.database_utms if geo_priors is not None else None,
+        )
+        if args.use_labels:
+            initial_correct = get_correct_matrix(initial_predictions, test_ds.get_positives())
+            initial_recalls = compute_recalls(initial_correct, args.recall_values)
+            logger.info(f"Recalls before QE/DBA: {get_recalls_str(initial_recalls, args.recall_values)}")
+
+    del database_descriptors, queries_descriptors
+    if args.dba_n and args.descriptors_memmap:
+        del augmented_descriptors
+        (log_dir / "database_descriptors_dba.npy").unlink()
+    if args.descriptors_memmap and not (args.save_descriptors and args.descriptors_format == "float32"):
+        (log_dir / "database_descriptors.npy").unlink()
+        (log_dir / "queries_descriptors.npy").unlink()
+
+    if baseline_predictions is not None:
+        knn_recalls = compute_knn_recalls(predictions, baseline_predictions, args.recall_values)
+        knn_recalls_str = get_recalls_str(knn_recalls, args.recall_values)
+        logger.info(f"Recalls of the exact nearest neighbour without PCA-whitening: {knn_recalls_str}")
 
     # For each query, check if the predictions are correct
     if args.use_labels:
+        for dist_threshold in args.positive_dist_threshold:
+            positives_per_query = test_ds.get_positives(dist_threshold)
+            recalls = compute_recalls(get_correct_matrix(predictions, positives_per_query), args.recall_values)
+            recalls_str = get_recalls_str(recalls, args.recall_values)
+            if baseline_predictions is not None:
+                baseline_correct = get_correct_matrix(baseline_predictions, positives_per_query)
+                baseline_recalls = compute_recalls(baseline_correct, args.recall_values)
+                recalls_str += f" (without PCA-whitening: {get_recalls_str(baseline_recalls, args.recall_values)})"
+            if len(args.positive_dist_threshold) > 1:
+                recalls_str = f"Positives within {dist_threshold} meters: {recalls_str}"
+            logger.info(recalls_str)
         positives_per_query = test_ds.get_positives()
-        recalls = np.zeros(len(args.recall_values))
-        for query_index, preds in enumerate(predictions):
-            for i, n in enumerate(args.recall_values):
-                if np.any(np.isin(preds[:n], positives_per_query[query_index])):
-                    recalls[i:] += 1
-                    break
-
-        # Divide by num_queries and multiply by 100, so the recalls are in percentages
-        recalls = recalls / test_ds.num_queries * 100
-        recalls_str = ", ".join([f"R@{val}: {rec:.1f}" for val, rec in zip(args.recall_values, recalls)])
-        logger.info(recalls_str)
 
     # Save visualizations of predictions
     if args.num_preds_to_save != 0:
@@ -107,7 +450,8 @@ def main(args):
     if args.save_for_uncertainty:
         z_data = {}
         z_data['database_utms'] = test_ds.database_utms
-        z_data['positives_per_query'] = positives_per_query
+        # Saved as an object array, so that z_data can be loaded without importing positives.py
+        z_data['positives_per_query'] = positives_per_query.to_object_array()
         z_data['predictions'] = predictions
         z_data['distances'] = distances
 
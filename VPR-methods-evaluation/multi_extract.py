@@ -0,0 +1,245 @@
+"""Extract the descriptors of multiple methods with a single pass over the images:
+each batch is decoded and normalized once, and then fed to every model, after
+resizing it to the input size of each model when it differs. Other per-model
+adaptations (e.g. the rounding to multiples of 14 of ResizingWrapper, or SFRS's
+renormalization) are applied by the models themselves, as in main.py.
+
+Usage:
+    python3 multi_extract.py --methods cosplace:ResNet50:2048 mixvpr salad megaloc \
+        --database_folder=path/to/database --queries_folder=path/to/queries
+
+Each method is given as method[:backbone[:descriptors_dimension]], and its
+descriptors are saved in its own folder within the log dir. The other arguments
+are the same as main.py's. With --descriptors_cache_dir, descriptors are read
+from and written to the cache of each method, which main.py then reuses, for the
+methods whose images are decoded exactly as main.py would decode them.
+"""
+
+import argparse
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from loguru import logger
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+import parser
+from descriptors_io import get_descriptors_path, save_descriptors
+from evaluation import compute_recalls, get_correct_matrix
+from main import find_predictions, get_descriptors_cache, get_recalls_str, load_model
+from test_dataset import BucketBatchSampler, TestDataset, get_resized_size
+
+
+class ModelAdapter:
+    """A model with the arguments of its method, which takes the batches decoded
+    at the shared image_size and resizes them to its own input size.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+    args : Namespace, arguments of main.py for this model (as set by load_model)
+    shared_image_size : list[int], image_size at which the images are decoded
+    """
+
+    def __init__(self, model, args, shared_image_size):
+        self.model = model
+        self.args = args
+        self.name = f"{args.method}_{args.backbone}_{args.descriptors_dimension}"
+        self.size_multiple = getattr(model, "input_size_multiple", None)
+        # The input size of the model, relative to the decoded images. None if they already have it
+        self.image_size = None if args.image_size == shared_image_size else args.image_size
+
+    def is_decoded_as_main(self, shared_args):
+        """Whether the images fed to the model are exactly the ones that main.py would
+        feed it, i.e. they are either decoded in the same way, or resized once from
+        the normalized images at their original resolution."""
+        if self.image_size is None:
+            return self.size_multiple is None
+        return shared_args.image_size is None and not shared_args.fast_decode
+
+    def __call__(self, images):
+        h, w = images.shape[-2:]
+        image_hw = get_resized_size(w, h, self.image_size, self.size_multiple)
+        if image_hw != (h, w):
+            images = transforms.functional.resize(images, list(image_hw), antialias=True)
+        return self.model(images)
+
+
+def get_models_args(arg_parser, argv):
+    """Return the arguments of each method of --methods, i.e. the arguments in argv
+    with --method, --backbone and --descriptors_dimension set from the method's spec."""
+    methods = arg_parser.parse_args(argv).methods
+    models_args = []
+    for spec in methods:
+        method, backbone, descriptors_dimension = (spec.split(":") + [None, None])[:3]
+        spec_argv = ["--method", method]
+        spec_argv += ["--backbone", backbone] if backbone else []
+        spec_argv += ["--descriptors_dimension", descriptors_dimension] if descriptors_dimension else []
+        model_args = arg_parser.parse_args(argv + spec_argv)
+        # The spec defines the whole model, so the --backbone and --descriptors_dimension in argv are ignored
+        model_args.backbone = model_args.backbone if backbone else None
+        model_args.descriptors_dimension = model_args.descriptors_dimension if descriptors_dimension else None
+        models_args.append(parser.check_arguments(model_args))
+    return models_args
+
+
+def extract_multi_descriptors(adapters, test_ds, indices_per_model, out_descriptors_per_model, offset, args):
+    """Extract with each adapter the descriptors of the images at its indices
+    (in indices_per_model), decoding each image once, and write them in the rows
+    (indices - offset) of its out_descriptors."""
+    indices = sorted(set().union(*indices_per_model))
+    if len(indices) == 0:
+        return
+    is_needed_per_model = []
+    for model_indices in indices_per_model:
+        is_needed = np.zeros(len(test_ds), dtype=bool)
+        is_needed[list(model_indices)] = True
+        is_needed_per_model.append(is_needed)
+    sampler = BucketBatchSampler(test_ds, indices, args.batch_size)
+    logger.debug(f"Images grouped in {sampler.num_buckets} buckets of same resolution")
+    dataloader = DataLoader(dataset=test_ds, num_workers=args.num_workers, batch_sampler=sampler)
+    with torch.inference_mode():
+        for images, indices in tqdm(dataloader):
+            images = images.to(args.device)
+            indices = indices.numpy()
+            for adapter, is_needed, out_descriptors in zip(adapters, is_needed_per_model, out_descriptors_per_model):
+                mask = is_needed[indices]
+                if not mask.any():
+                    continue
+                batch = images if mask.all() else images[torch.from_numpy(mask).to(args.device)]
+                out_descriptors[indices[mask] - offset, :] = adapter(batch).cpu().numpy()
+
+
+def parse_arguments():
+    arg_parser = parser.get_parser()
+    arg_parser.add_argument(
+        "--methods",
+        type=str,
+        nargs="+",
+        required=True,
+        help="methods to extract the descriptors of, as method[:backbone[:descriptors_dimension]]. "
+        "All their models are loaded on --device at once",
+    )
+    models_args = get_models_args(arg_parser, sys.argv[1:])
+    # The shared arguments, with the image_size set by --image_size (which load_model changes with
+    # --fast_decode for the methods with a fixed input size), at which the images are decoded
+    args = argparse.Namespace(**vars(models_args[0]))
+    args.image_size = arg_parser.parse_args().image_size
+    if (
+        args.use_tta
+        or args.database_store
+        or args.pca_dim is not None
+        or args.qe_n
+        or args.dba_n
+        or args.geo_priors is not None
+        or args.geo_prior_radius is not None
+    ):
+        raise ValueError(
+            "multi_extract.py does not support --tta_*, --database_store, --pca_dim, --qe_n, --dba_n and geographic priors"
+        )
+    return args, models_args
+
+
+def main(args, models_args):
+    start_time = datetime.now()
+    logger.remove()
+    log_dir = Path("logs") / args.log_dir / start_time.strftime("%Y-%m-%d_%H-%M-%S")
+    logger.add(sys.stdout, colorize=True, format="<green>{time:%Y-%m-%d %H:%M:%S}</green> {message}", level="INFO")
+    logger.add(log_dir / "info.log", format="<green>{time:%Y-%m-%d %H:%M:%S}</green> {message}", level="INFO")
+    logger.add(log_dir / "debug.log", level="DEBUG")
+    logger.info(" ".join(sys.argv))
+    logger.info(f"Arguments: {args}")
+    logger.info(f"The outputs are being saved in {log_dir}")
+
+    adapters = [ModelAdapter(load_model(model_args), model_args, args.image_size) for model_args in models_args]
+    logger.info(f"Extracting the descriptors of {', '.join(adapter.name for adapter in adapters)}")
+
+    test_ds = TestDataset(
+        args.database_folder,
+        args.queries_folder,
+        positive_dist_threshold=args.positive_dist_threshold,
+        image_size=args.image_size,
+        use_labels=args.use_labels,
+        fast_decode=args.fast_decode,
+        image_shards_dir=args.image_shards_dir,
+        positives_cache_dir=args.positives_cache_dir,
+    )
+    logger.info(f"Testing on {test_ds}")
+
+    all_indices = [list(range(test_ds.num_database)), list(range(test_ds.num_database, len(test_ds)))]
+    descriptors_per_model, indices_per_model, caches = [], [], []
+    for adapter in adapters:
+        (log_dir / adapter.name).mkdir(parents=True, exist_ok=True)
+        shapes = [(test_ds.num_database,), (test_ds.num_queries,)]
+        if args.descriptors_memmap:
+            descriptors = [
+                np.lib.format.open_memmap(
+                    log_dir / adapter.name / f"{name}.npy",
+                    mode="w+",
+                    dtype="float32",
+                    shape=shape + (adapter.args.descriptors_dimension,),
+                )
+                for name, shape in zip(["database_descriptors", "queries_descriptors"], shapes)
+            ]
+        else:
+            descriptors = [np.empty(shape + (adapter.args.descriptors_dimension,), dtype="float32") for shape in shapes]
+        indices = all_indices
+        cache = None
+        if args.descriptors_cache_dir and adapter.is_decoded_as_main(args):
+            cache = get_descriptors_cache(adapter.model, adapter.args)
+            indices = [
+                [i + offset for i in cache.read(paths, out)]
+                for paths, out, offset in zip(
+                    [test_ds.database_paths, test_ds.queries_paths], descriptors, [0, test_ds.num_database]
+                )
+            ]
+            logger.info(f"{adapter.name}: using {cache}, extracting {len(indices[0]) + len(indices[1])} descriptors")
+        elif args.descriptors_cache_dir:
+            logger.info(f"{adapter.name}: images are resized differently than with main.py, so the cache is not used")
+        descriptors_per_model.append(descriptors)
+        indices_per_model.append(indices)
+        caches.append(cache)
+
+    for i, (name, offset) in enumerate([("database", 0), ("queries", test_ds.num_database)]):
+        logger.debug(f"Extracting {name} descriptors with {len(adapters)} models")
+        extract_multi_descriptors(
+            adapters,
+            test_ds,
+            [indices[i] for indices in indices_per_model],
+            [descriptors[i] for descriptors in descriptors_per_model],
+            offset,
+            args,
+        )
+
+    for adapter, descriptors, indices, cache in zip(adapters, descriptors_per_model, indices_per_model, caches):
+        database_descriptors, queries_descriptors = descriptors
+        if cache is not None:
+            for out, model_indices, offset in zip(descriptors, indices, [0, test_ds.num_database]):
+                cache.write(
+                    [test_ds.images_paths[i] for i in model_indices], out[np.array(model_indices, dtype=int) - offset]
+                )
+        if args.descriptors_memmap:
+            database_descriptors.flush()
+            queries_descriptors.flush()
+        if not (args.descriptors_memmap and args.descriptors_format == "float32"):
+            for name, out in zip(["database_descriptors", "queries_descriptors"], descriptors):
+                save_descriptors(
+                    get_descriptors_path(log_dir / adapter.name, name, args.descriptors_format),
+                    out,
+                    args.descriptors_format,
+                )
+        logger.info(f"Saved the descriptors of {adapter.name} in {log_dir / adapter.name}")
+
+        if args.use_labels:
+            _, predictions = find_predictions(database_descriptors, queries_descriptors, None, adapter.args)
+            recalls = compute_recalls(get_correct_matrix(predictions, test_ds.get_positives()), args.recall_values)
+            logger.info(f"{adapter.name}: {get_recalls_str(recalls, args.recall_values)}")
+
+
+if __name__ == "__main__":
+    args, models_args = parse_arguments()
+    main(args, models_args)
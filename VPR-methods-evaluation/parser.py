@@ -1,14 +1,18 @@
 import argparse
 
 
-def parse_arguments():
+def get_parser(queries_folder_required=True):
+    """Return the argparse parser of the arguments of main.py, which other
+    scripts (e.g. server.py) can extend with their own arguments."""
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument(
         "--positive_dist_threshold",
         type=int,
-        default=25,
-        help="distance (in meters) for a prediction to be considered a positive",
+        nargs="+",
+        default=[25],
+        help="distance (in meters) for a prediction to be considered a positive. If multiple values are "
+        "passed, recalls are computed for each of them, and the first one is used for everything else",
     )
     parser.add_argument(
         "--method",
@@ -48,10 +52,13 @@ def parse_arguments():
     )
     parser.add_argument("--descriptors_dimension", type=int, default=None, help="_")
     parser.add_argument("--database_folder", type=str, required=True, help="path/to/database")
-    parser.add_argument("--queries_folder", type=str, required=True, help="path/to/queries")
+    parser.add_argument("--queries_folder", type=str, required=queries_folder_required, help="path/to/queries")
     parser.add_argument("--num_workers", type=int, default=4, help="_")
     parser.add_argument(
-        "--batch_size", type=int, default=4, help="set to 1 if database images may have different resolution"
+        "--batch_size",
+        type=int,
+        default=4,
+        help="images with different resolution are automatically put in different batches",
     )
     parser.add_argument(
         "--log_dir", type=str, default="default", help="experiment name, output logs will be saved under logs/log_dir"
@@ -86,19 +93,192 @@ def parse_arguments():
         help="Resizing shape for images (HxW). If a single int is passed, set the"
         "smallest edge of all images to this value, while keeping aspect ratio",
     )
+    parser.add_argument(
+        "--tta_scales",
+        type=float,
+        nargs="+",
+        default=[1],
+        help="test-time augmentation: extract the descriptors at these scales (relative to the resized images), "
+        "and pool them. All the views of an image are generated from a single decoding",
+    )
+    parser.add_argument("--tta_flip", action="store_true", help="test-time augmentation with horizontal flips")
+    parser.add_argument(
+        "--tta_pool",
+        type=str,
+        default="mean",
+        choices=["mean", "gem"],
+        help="pooling of the descriptors of the test-time augmentation views",
+    )
+    parser.add_argument(
+        "--fast_decode",
+        action="store_true",
+        help="decode JPEGs at reduced resolution (draft mode) and resize them in uint8 before normalization, "
+        "which is much faster for high resolution images. Models with a fixed input size (e.g. MixVPR) get "
+        "images directly resized to it, unless --image_size is set",
+    )
+    parser.add_argument(
+        "--image_shards_dir",
+        type=str,
+        default=None,
+        help="folder with shards of pre-decoded images (see image_shards.py), which are much faster to read "
+        "than JPEGs. Shards are built if they don't exist yet. With --fast_decode images are stored resized, "
+        "otherwise at their original resolution and resized when read, giving the same descriptors as without shards. "
+        "Shards hold raw pixels, so at the original resolution they usually take 10-20x the disk space of the JPEGs",
+    )
     parser.add_argument(
         "--save_descriptors",
         action="store_true",
         help="set to True if you want to save the descriptors extracted by the model",
     )
+    parser.add_argument(
+        "--descriptors_format",
+        type=str,
+        default="float32",
+        choices=["float32", "float16", "int8"],
+        help="format of the descriptors saved with --save_descriptors: float16, or int8 with a per-dimension "
+        "scale and offset, take 2x and 4x less space and can be read with descriptors_io.DescriptorsReader",
+    )
+    parser.add_argument(
+        "--descriptors_memmap",
+        action="store_true",
+        help="write descriptors batch by batch into memory-mapped .npy files in the log dir, instead of "
+        "keeping them in RAM. The files are kept only if --save_descriptors is set",
+    )
+    parser.add_argument(
+        "--descriptors_cache_dir",
+        type=str,
+        default=None,
+        help="folder of a persistent descriptors cache: descriptors of images already in the cache "
+        "(extracted with the same model and image_size) are not extracted again",
+    )
+    parser.add_argument(
+        "--database_store",
+        type=str,
+        default=None,
+        help="folder of a persistent store of the database descriptors and of their --faiss_index, which is "
+        "updated incrementally: only new database images are extracted and added to the index, and removed images "
+        "are tombstoned",
+    )
+    parser.add_argument(
+        "--compact_database_store",
+        action="store_true",
+        help="drop the tombstones of the --database_store, renumbering its images and rebuilding its index",
+    )
+    parser.add_argument(
+        "--positives_cache_dir",
+        type=str,
+        default=None,
+        help="folder where positives are cached, so that they are not recomputed in later runs",
+    )
+    parser.add_argument(
+        "--search_memory_mb",
+        type=int,
+        default=1024,
+        help="memory budget (in MB) of the exhaustive search, which processes queries and database in blocks",
+    )
+    parser.add_argument(
+        "--search_num_threads", type=int, default=1, help="number of queries blocks searched in parallel"
+    )
+    parser.add_argument(
+        "--pca_dim",
+        type=int,
+        default=None,
+        help="reduce the descriptors to this dimension with a PCA-whitening fitted on the database descriptors, "
+        "before indexing. Recalls are also reported without the reduction, as a baseline",
+    )
+    parser.add_argument(
+        "--pca_train_size", type=int, default=100000, help="number of database descriptors used to fit the PCA"
+    )
+    parser.add_argument(
+        "--pca_path",
+        type=str,
+        default=None,
+        help="path of the PCA-whitening: it is loaded if it exists, otherwise it is fitted and saved there",
+    )
+    parser.add_argument(
+        "--geo_priors",
+        type=str,
+        default=None,
+        help="CSV file with rows query_path,utm_east,utm_north,radius: each query listed there is only searched "
+        "within the database images within radius meters from its prior. Other queries search the whole database",
+    )
+    parser.add_argument(
+        "--geo_prior_radius",
+        type=float,
+        default=None,
+        help="search each query only within this radius (in meters) from its own UTM coordinates, "
+        "to simulate a GPS prior",
+    )
+    parser.add_argument(
+        "--geo_grid_cell_size",
+        type=float,
+        default=100,
+        help="side (in meters) of the cells of the grid used to find the database images within the priors",
+    )
+    parser.add_argument(
+        "--qe_n",
+        type=int,
+        default=0,
+        help="alpha query expansion: expand each query with its first qe_n predictions, and search again",
+    )
+    parser.add_argument(
+        "--dba_n",
+        type=int,
+        default=0,
+        help="database-side augmentation: expand each database descriptor with its dba_n nearest database descriptors",
+    )
+    parser.add_argument(
+        "--qe_alpha",
+        type=float,
+        default=3.0,
+        help="exponent of the similarities used as weights by query expansion and database-side augmentation",
+    )
+    parser.add_argument(
+        "--num_index_shards",
+        type=int,
+        default=1,
+        help="split the database in this number of shards for the exhaustive search, each held in shared memory "
+        "and searched by a separate process. Results are identical to the ones with a single shard",
+    )
+    parser.add_argument(
+        "--faiss_index",
+        type=str,
+        default="Flat",
+        help="FAISS index_factory string of the index used for search, e.g. Flat, IVF4096,Flat, IVF4096,PQ64, "
+        "HNSW32 or SQ8. Non-Flat indexes are saved, and reloaded in later runs, next to the cached descriptors "
+        "if --descriptors_cache_dir is set, or in --faiss_index_path. Otherwise they are only written in the log "
+        "dir of the run, and never reused",
+    )
+    parser.add_argument(
+        "--faiss_index_path",
+        type=str,
+        default=None,
+        help="path of the FAISS index: it is loaded if it exists and was built with the same --faiss_index and "
+        "--faiss_train_size over the same number of descriptors, otherwise it is built and saved there",
+    )
+    parser.add_argument(
+        "--faiss_train_size", type=int, default=100000, help="number of database descriptors used for training"
+    )
+    parser.add_argument("--faiss_nprobe", type=int, default=None, help="number of cells visited by IVF indexes")
+    parser.add_argument("--faiss_ef_search", type=int, default=None, help="efSearch of HNSW indexes")
+    parser.add_argument(
+        "--faiss_exact_baseline",
+        action="store_true",
+        help="also run an exhaustive search, and log the recalls of the exact nearest neighbours and the latency",
+    )
     parser.add_argument(
         "--save_for_uncertainty",
         action="store_true",
         help="set to True if you want to save the data for uncertainty estimation",
     )
-    args = parser.parse_args()
+    return parser
+
 
+def check_arguments(args):
+    """Validate the arguments parsed by get_parser(), and set the defaults that
+    depend on the method (e.g. its descriptors dimension)."""
     args.use_labels = not args.no_labels
+    args.use_tta = args.tta_scales != [1] or args.tta_flip
 
     if args.method == "netvlad":
         if args.backbone not in [None, "VGG16"]:
@@ -234,4 +414,28 @@ def parse_arguments():
             f"The --image_size parameter can only take up to 2 values, but has received {len(args.image_size)}."
         )
 
+    if args.qe_n > max(args.recall_values):
+        raise ValueError(f"--qe_n must be at most max(--recall_values) = {max(args.recall_values)}")
+    if args.database_store and (
+        args.pca_dim is not None
+        or args.qe_n
+        or args.dba_n
+        or args.num_index_shards > 1
+        or args.save_descriptors
+        or args.geo_priors is not None
+        or args.geo_prior_radius is not None
+    ):
+        raise ValueError(
+            "--database_store can't be used with --pca_dim, --qe_n, --dba_n, --num_index_shards, "
+            "--save_descriptors and geographic priors, which need all the database descriptors"
+        )
+    if (args.geo_priors is not None or args.geo_prior_radius is not None) and not args.use_labels:
+        raise ValueError("--geo_priors and --geo_prior_radius need the UTMs of the database, so they need the labels")
+    if (args.geo_priors is not None or args.geo_prior_radius is not None) and args.faiss_index != "Flat":
+        raise ValueError("--geo_priors and --geo_prior_radius can only be used with an exhaustive search (Flat)")
+
     return args
+
+
+def parse_arguments():
+    return check_arguments(get_parser().parse_args())
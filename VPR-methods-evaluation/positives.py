@@ -0,0 +1,94 @@
+import hashlib
+import os
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+
+class Positives:
+    """Compact (CSR-like) storage of the positives of each query: the positives
+    of query i are indices[starts[i] : ends[i]], sorted by distance.
+    It can be used as a drop-in replacement for the object array returned by
+    NearestNeighbors.radius_neighbors, i.e. positives[i] returns an array.
+    """
+
+    def __init__(self, starts, ends, indices):
+        self.starts = starts
+        self.ends = ends
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, query_index):
+        return self.indices[self.starts[query_index] : self.ends[query_index]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def to_object_array(self):
+        """Return an object array of index arrays, as radius_neighbors does."""
+        positives_per_query = np.empty(len(self), dtype=object)
+        for query_index in range(len(self)):
+            positives_per_query[query_index] = self[query_index].astype(np.int64)
+        return positives_per_query
+
+
+def compute_positives(database_utms, queries_utms, dist_thresholds, queries_chunk_size=10000):
+    """Compute the positives within each of dist_thresholds in a single radius
+    search at the largest threshold, processing queries in chunks to bound memory.
+
+    Returns
+    -------
+    offsets : np.array of int64 of shape [num_queries + 1], start of the
+        positives of each query (at the largest threshold) within indices
+    indices : np.array of int32, indices of the positives, sorted by distance
+    counts : dict int -> np.array of int64 of shape [num_queries], number of
+        positives of each query within each threshold
+    """
+    knn = NearestNeighbors(n_jobs=-1)
+    knn.fit(database_utms)
+    max_threshold = max(dist_thresholds)
+    indices_chunks = []
+    counts = {threshold: [] for threshold in dist_thresholds}
+    for start in range(0, len(queries_utms), queries_chunk_size):
+        distances, indices = knn.radius_neighbors(
+            queries_utms[start : start + queries_chunk_size], radius=max_threshold, sort_results=True
+        )
+        for threshold in dist_thresholds:
+            # Results are sorted by distance, so the positives within a smaller threshold are a prefix
+            counts[threshold].append([np.searchsorted(d, threshold, side="right") for d in distances])
+        indices_chunks.extend(indices)
+    counts = {threshold: np.concatenate(c).astype(np.int64) for threshold, c in counts.items()}
+    offsets = np.zeros(len(queries_utms) + 1, dtype=np.int64)
+    np.cumsum(counts[max_threshold], out=offsets[1:])
+    indices = np.concatenate(indices_chunks).astype(np.int32) if indices_chunks else np.zeros(0, dtype=np.int32)
+    return offsets, indices, counts
+
+
+def get_positives(database_utms, queries_utms, dist_thresholds, cache_dir=None):
+    """Return a dict threshold -> Positives. If cache_dir is set, positives are
+    saved to (and later read from) a file keyed by the UTMs and the thresholds.
+    """
+    dist_thresholds = sorted(set(dist_thresholds))
+    cache_path = None
+    if cache_dir:
+        hasher = hashlib.sha1()
+        hasher.update(np.ascontiguousarray(database_utms, dtype=np.float64).tobytes())
+        hasher.update(np.ascontiguousarray(queries_utms, dtype=np.float64).tobytes())
+        hasher.update(str(dist_thresholds).encode())
+        cache_path = os.path.join(cache_dir, f"positives_{hasher.hexdigest()[:16]}.npz")
+
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            offsets, indices = data["offsets"], data["indices"]
+            counts = {threshold: data[f"counts_{threshold}"] for threshold in dist_thresholds}
+    else:
+        offsets, indices, counts = compute_positives(database_utms, queries_utms, dist_thresholds)
+        if cache_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            counts_arrays = {f"counts_{threshold}": c for threshold, c in counts.items()}
+            np.savez(cache_path, offsets=offsets, indices=indices, **counts_arrays)
+
+    starts = offsets[:-1]
+    return {threshold: Positives(starts, starts + counts[threshold], indices) for threshold in dist_thresholds}
@@ -0,0 +1,61 @@
+"""Alpha query expansion (alpha-QE) and database-side augmentation (DBA), as in
+dirtorch.test_dir.expand_descriptors, but computed from the top-k neighbours
+returned by a previous search instead of a dense similarity matrix: each
+descriptor is replaced by the L2-normalized sum of itself and of its neighbours
+weighted by their similarity to the power of alpha.
+"""
+
+import numpy as np
+
+
+def get_similarities(distances):
+    """Return the cosine similarities corresponding to the squared L2 distances
+    between L2-normalized descriptors (as returned by FAISS), clipped at 0."""
+    return np.clip(1 - np.asarray(distances, dtype="float32") / 2, 0, None)
+
+
+def expand_descriptors(descriptors, database_descriptors, distances, predictions, alpha=3, out=None, chunk_size=10000):
+    """Expand each descriptor with its neighbours within database_descriptors.
+
+    Parameters
+    ----------
+    descriptors : np.array (or np.memmap) of shape [num_descriptors x dim]
+    database_descriptors : np.array (or np.memmap) of shape [num_database x dim]
+    distances : np.array of shape [num_descriptors x num_neighbours], squared L2
+        distances of the neighbours. Only the first num_neighbours columns of
+        the output of a search should be passed
+    predictions : np.array of shape [num_descriptors x num_neighbours], indices of
+        the neighbours, -1 for missing neighbours (which are ignored)
+    alpha : float, exponent of the similarities used as weights
+    out : np.array of shape [num_descriptors x dim] where to write the expanded
+        descriptors, it can be descriptors itself
+    chunk_size : int, number of descriptors expanded at a time
+
+    Returns
+    -------
+    out : np.array of float32 of shape [num_descriptors x dim]
+    """
+    if out is None:
+        out = np.empty(descriptors.shape, dtype="float32")
+    for start in range(0, len(descriptors), chunk_size):
+        chunk_predictions = np.asarray(predictions[start : start + chunk_size])
+        weights = get_similarities(distances[start : start + chunk_size]) ** alpha
+        weights[chunk_predictions < 0] = 0
+        # Gather the neighbours of the whole chunk at once, reading the (memory-mapped) database in sorted order
+        unique_predictions, inverse = np.unique(np.maximum(chunk_predictions, 0), return_inverse=True)
+        neighbours = np.asarray(database_descriptors[unique_predictions], dtype="float32")
+        neighbours = neighbours[inverse.reshape(chunk_predictions.shape)]
+        expanded = np.asarray(descriptors[start : start + chunk_size], dtype="float32")
+        expanded = expanded + np.einsum("qn,qnd->qd", weights, neighbours)
+        expanded /= np.maximum(np.linalg.norm(expanded, axis=1, keepdims=True), 1e-12)
+        out[start : start + chunk_size] = expanded
+    return out
+
+
+def remove_self_matches(distances, predictions, num_neighbours):
+    """From the output of a search of the database within itself, remove each
+    descriptor from its own neighbours, and return the first num_neighbours others."""
+    is_self = predictions == np.arange(len(predictions))[:, None]
+    # A stable sort moves the self matches to the end, keeping the other neighbours in order
+    order = np.argsort(is_self, axis=1, kind="stable")[:, :num_neighbours]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(predictions, order, axis=1)
@@ -0,0 +1,72 @@
+"""Exact k-nearest-neighbours search with bounded memory. Queries are processed
+in blocks (in parallel threads), and each block is compared against shards of
+the database, merging the top-k results of each shard with a running heap, so
+that the full [num_queries x num_database] distance matrix is never built and
+the database can be a np.memmap larger than RAM.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+
+def get_blocks_sizes(dim, num_database, k, memory_budget_mb=1024, num_threads=1):
+    """Return (queries_block_size, database_shard_size) such that the memory
+    used by each thread (a database shard, a queries block and their distances)
+    fits within memory_budget_mb / num_threads."""
+    budget = memory_budget_mb * 2**20 / num_threads
+    # Half of the budget goes to the database shard, the rest to queries and distances
+    database_shard_size = int(min(num_database, max(k, budget / 2 / (dim * 4))))
+    queries_block_size = int(max(1, budget / 2 / ((dim + database_shard_size) * 4)))
+    return queries_block_size, database_shard_size
+
+
+def search_block(queries_block, database, k, database_shard_size):
+    """Exact search of queries_block over all the shards of database."""
+    queries_block = np.ascontiguousarray(queries_block, dtype="float32")
+    result_heap = faiss.ResultHeap(len(queries_block), k)
+    for start in range(0, len(database), database_shard_size):
+        database_shard = np.ascontiguousarray(database[start : start + database_shard_size], dtype="float32")
+        distances, predictions = faiss.knn(queries_block, database_shard, min(k, len(database_shard)))
+        result_heap.add_result(distances, predictions + start)
+    result_heap.finalize()
+    return result_heap.D, result_heap.I
+
+
+def chunked_search(queries, database, k, memory_budget_mb=1024, num_threads=1, blocks_sizes=None):
+    """Exact L2 search of the k nearest neighbours of queries within database,
+    with the same output as faiss.IndexFlatL2.search, but with bounded memory.
+
+    Parameters
+    ----------
+    queries : np.array (or np.memmap) of shape [num_queries x dim]
+    database : np.array (or np.memmap) of shape [num_database x dim]
+    k : int, number of neighbours
+    memory_budget_mb : int, approximate memory used by the search, in MB
+    num_threads : int, number of queries blocks searched in parallel
+    blocks_sizes : tuple (queries_block_size, database_shard_size), overrides
+        the sizes computed from memory_budget_mb
+
+    Returns
+    -------
+    distances : np.array of float32 of shape [num_queries x k], squared L2 distances
+    predictions : np.array of int64 of shape [num_queries x k]
+    """
+    num_queries, dim = queries.shape
+    if blocks_sizes is None:
+        blocks_sizes = get_blocks_sizes(dim, len(database), k, memory_budget_mb, num_threads)
+    queries_block_size, database_shard_size = blocks_sizes
+    distances = np.empty((num_queries, k), dtype="float32")
+    predictions = np.empty((num_queries, k), dtype="int64")
+
+    def search_and_store(start):
+        end = start + queries_block_size
+        distances[start:end], predictions[start:end] = search_block(
+            queries[start:end], database, k, database_shard_size
+        )
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        # list() propagates exceptions raised within the threads
+        list(executor.map(search_and_store, range(0, num_queries, queries_block_size)))
+    return distances, predictions
@@ -0,0 +1,297 @@
+"""Resident localization service: the model, the database descriptors and the
+index are loaded once, and then query images are localized through HTTP, on
+localhost or on a Unix socket. Concurrent requests are grouped in micro-batches,
+so that the model and the search process multiple queries at once.
+
+Usage:
+    python3 server.py --method=cosplace --backbone=ResNet18 --descriptors_dimension=512 \
+        --database_folder=toy_dataset/database --descriptors_cache_dir=cache --port=8000
+    curl --data-binary @query.jpg "http://127.0.0.1:8000/localize?k=5"
+
+The response is a JSON with the path, UTM east, UTM north and (squared L2)
+distance of the top-k predictions. The model, image size and search arguments
+are the same as main.py's, while the queries folder is not needed.
+"""
+
+import io
+import json
+import queue
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+from loguru import logger
+from PIL import Image
+
+import parser
+from images_index import parse_images_fields, read_images_utms
+from indexes import load_or_build_index, set_search_parameters
+from main import extract_descriptors, get_descriptors_cache, get_size_multiple, load_model
+from search import chunked_search
+from test_dataset import TestDataset
+
+
+class MicroBatcher:
+    """Group the queries submitted by concurrent threads into batches of up to
+    batch_size queries, waiting at most max_wait_ms for a batch to fill up,
+    and compute their descriptors and predictions in a single background thread.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+    search_fn : callable(queries_descriptors, k) -> (distances, predictions)
+    device : str
+    batch_size : int
+    max_wait_ms : float
+    """
+
+    def __init__(self, model, search_fn, device, batch_size=32, max_wait_ms=5):
+        self.model = model
+        self.search_fn = search_fn
+        self.device = device
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, k):
+        """Return (distances, predictions) of the k nearest neighbours of image,
+        a normalized tensor of shape [3 x H x W]. Blocks until they are computed."""
+        future = Future()
+        self.queue.put((image, k, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            requests = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait_ms / 1000
+            while len(requests) < self.batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._process(requests)
+            except Exception:
+                # Process the queries one by one, so that a failing query doesn't fail the others of its batch
+                for request in requests:
+                    try:
+                        self._process([request])
+                    except Exception as e:
+                        request[2].set_exception(e)
+
+    def _process(self, requests):
+        # Images can only be stacked with images of the same resolution
+        positions_per_shape = {}
+        for position, (image, _, _) in enumerate(requests):
+            positions_per_shape.setdefault(tuple(image.shape), []).append(position)
+        descriptors = [None] * len(requests)
+        with torch.inference_mode():
+            for positions in positions_per_shape.values():
+                images = torch.stack([requests[position][0] for position in positions])
+                for position, descriptor in zip(positions, self.model(images.to(self.device)).cpu().numpy()):
+                    descriptors[position] = descriptor
+        k = max(k for _, k, _ in requests)
+        distances, predictions = self.search_fn(np.stack(descriptors).astype("float32"), k)
+        for position, (_, k, future) in enumerate(requests):
+            future.set_result((distances[position, :k], predictions[position, :k]))
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class LocalizationHandler(BaseHTTPRequestHandler):
+    """Handle GET /health and POST /localize?k=K, whose body is an image file.
+    The server must have the attributes database_ds, database_utms, batcher and default_k."""
+
+    def address_string(self):
+        # Clients of Unix sockets have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+        self.send_json(200, {"status": "ok", "num_database": self.server.database_ds.num_database})
+
+    def do_POST(self):
+        start_time = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path != "/localize":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+        try:
+            k = int(parse_qs(url.query).get("k", [self.server.default_k])[0])
+            if k < 1:
+                raise ValueError(f"k must be positive, not {k}")
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            image = self.server.database_ds.preprocess_image(Image.open(io.BytesIO(body)))
+        except Exception as e:
+            return self.send_json(400, {"error": f"Invalid request: {e}"})
+        try:
+            distances, predictions = self.server.batcher.submit(image, k)
+        except Exception as e:
+            logger.exception("Search failed")
+            return self.send_json(500, {"error": f"Search failed: {e}"})
+        results = []
+        for distance, prediction in zip(distances, predictions):
+            if prediction < 0:
+                continue
+            utm_east, utm_north = self.server.database_utms[prediction]
+            results.append(
+                {
+                    "path": self.server.database_ds.database_paths[prediction],
+                    "utm_east": float(utm_east),
+                    "utm_north": float(utm_north),
+                    "distance": float(distance),
+                }
+            )
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        self.send_json(200, {"predictions": results, "latency_ms": latency_ms})
+
+
+def load_database(model, args):
+    """Return the database TestDataset, its UTMs (NaN for paths without them)
+    and its descriptors, read from the descriptors cache when possible."""
+    database_ds = TestDataset(
+        args.database_folder,
+        None,
+        image_size=args.image_size,
+        use_labels=False,
+        size_multiple=get_size_multiple(model, args),
+        fast_decode=args.fast_decode,
+        image_shards_dir=args.image_shards_dir,
+    )
+    database_utms = read_images_utms(args.database_folder, database_ds.database_paths)
+    if database_utms is None:
+        database_utms = parse_images_fields(database_ds.database_paths)[0]
+
+    database_descriptors = np.empty((database_ds.num_database, args.descriptors_dimension), dtype="float32")
+    database_indices = list(range(database_ds.num_database))
+    if args.descriptors_cache_dir:
+        descriptors_cache = get_descriptors_cache(model, args)
+        database_indices = descriptors_cache.read(database_ds.database_paths, database_descriptors)
+        logger.info(f"Using {descriptors_cache}, extracting {len(database_indices)} database descriptors")
+    extract_descriptors(model, database_ds, database_indices, database_descriptors, 0, args)
+    if args.descriptors_cache_dir:
+        descriptors_cache.write(
+            [database_ds.database_paths[i] for i in database_indices], database_descriptors[database_indices]
+        )
+    return database_ds, database_utms, database_descriptors
+
+
+def get_search_fn(database_descriptors, args, log_dir):
+    """Return the search function over the database, with an exhaustive search
+    or with the index built (or loaded) from --faiss_index."""
+    if args.faiss_index == "Flat":
+        return lambda queries_descriptors, k: chunked_search(
+            queries_descriptors, database_descriptors, k, args.search_memory_mb, args.search_num_threads
+        )
+    index_path = args.faiss_index_path
+    if index_path is None:
+        index_path = log_dir / "database_index.faiss"
+        logger.info(
+            f"The {args.faiss_index} index is saved in the log dir and is not reused when the server is restarted, "
+            "set --faiss_index_path to reuse it"
+        )
+    faiss_index, loaded = load_or_build_index(index_path, database_descriptors, args.faiss_index, args.faiss_train_size)
+    logger.info(f"{'Loaded' if loaded else 'Built and saved'} {args.faiss_index} index in {index_path}")
+    set_search_parameters(faiss_index, args.faiss_nprobe, args.faiss_ef_search)
+    return faiss_index.search
+
+
+def parse_arguments():
+    arg_parser = parser.get_parser(queries_folder_required=False)
+    arg_parser.add_argument("--host", type=str, default="127.0.0.1", help="host of the HTTP server")
+    arg_parser.add_argument("--port", type=int, default=8000, help="port of the HTTP server")
+    arg_parser.add_argument(
+        "--unix_socket", type=str, default=None, help="serve on this Unix socket instead of on host:port"
+    )
+    arg_parser.add_argument(
+        "--max_batch_wait_ms",
+        type=float,
+        default=5,
+        help="maximum time that a query waits for other queries to fill a batch (of up to --batch_size queries)",
+    )
+    args = parser.check_arguments(arg_parser.parse_args())
+    if (
+        args.use_tta
+        or args.pca_dim is not None
+        or args.qe_n
+        or args.dba_n
+        or args.num_index_shards > 1
+        or args.database_store
+        or args.geo_priors is not None
+        or args.geo_prior_radius is not None
+        or args.faiss_exact_baseline
+        or args.save_descriptors
+        or args.descriptors_memmap
+    ):
+        raise ValueError(
+            "server.py does not support --tta_*, --pca_dim, --qe_n, --dba_n, --num_index_shards, --database_store, "
+            "--geo_priors, --geo_prior_radius, --faiss_exact_baseline, --save_descriptors and --descriptors_memmap"
+        )
+    return args
+
+
+def main(args):
+    start_time = datetime.now()
+    logger.remove()
+    log_dir = Path("logs") / args.log_dir / start_time.strftime("%Y-%m-%d_%H-%M-%S")
+    logger.add(sys.stdout, colorize=True, format="<green>{time:%Y-%m-%d %H:%M:%S}</green> {message}", level="INFO")
+    logger.add(log_dir / "info.log", format="<green>{time:%Y-%m-%d %H:%M:%S}</green> {message}", level="INFO")
+    logger.add(log_dir / "debug.log", level="DEBUG")
+    logger.info(" ".join(sys.argv))
+    logger.info(f"Arguments: {args}")
+
+    model = load_model(args)
+    database_ds, database_utms, database_descriptors = load_database(model, args)
+    search_fn = get_search_fn(database_descriptors, args, log_dir)
+
+    if args.unix_socket:
+        Path(args.unix_socket).unlink(missing_ok=True)
+        server = ThreadingUnixHTTPServer(args.unix_socket, LocalizationHandler)
+        address = f"unix:{args.unix_socket}"
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), LocalizationHandler)
+        address = f"http://{args.host}:{server.server_address[1]}"
+    server.database_ds = database_ds
+    server.database_utms = database_utms
+    server.batcher = MicroBatcher(model, search_fn, args.device, args.batch_size, args.max_batch_wait_ms)
+    server.default_k = max(args.recall_values)
+    logger.info(f"Serving {database_ds.num_database} database images on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket:
+            Path(args.unix_socket).unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,144 @@
+"""Exact search over a database split into shards, each held in shared memory
+and searched by its own worker process, so that the search scales across cores
+(and, with one shard per NUMA node, across memory domains). Queries are sent to
+all shards, and the per-shard top-k lists are merged in the main process.
+
+The queries are split into the same blocks as in search.chunked_search, so the
+distances (which depend on the blocking of queries within the BLAS calls, but
+not on the partition of the database) and the predictions are identical to the
+ones of the single-process path.
+"""
+
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import faiss
+import numpy as np
+
+from search import chunked_search, get_blocks_sizes
+
+
+def _serve_shard(connection, shm_name, shape, start, num_threads, omp_num_threads):
+    """Worker loop: search the queries received from connection within the
+    database shard stored in the shared memory block shm_name."""
+    faiss.omp_set_num_threads(omp_num_threads)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    database_shard = np.ndarray(shape, dtype="float32", buffer=shm.buf)
+    connection.send("ready")
+    try:
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            queries, k, blocks_sizes = message
+            try:
+                distances, predictions = chunked_search(
+                    queries, database_shard, k, num_threads=num_threads, blocks_sizes=blocks_sizes
+                )
+                # Missing results (-1, when the shard has fewer than k descriptors) are left as they are
+                predictions = np.where(predictions >= 0, predictions + start, -1)
+                connection.send((distances, predictions))
+            except Exception as e:
+                connection.send(e)
+    finally:
+        del database_shard
+        shm.close()
+        connection.close()
+
+
+class ShardedIndex:
+    """Exact L2 index whose database is split into num_shards contiguous shards,
+    each searched by a separate process. It has the same search() output as
+    search.chunked_search (and faiss.IndexFlatL2) over the whole database.
+
+    Parameters
+    ----------
+    database_descriptors : np.array (or np.memmap) of shape [num_database x dim]
+    num_shards : int, number of shards (and worker processes)
+    memory_budget_mb : int, memory budget of the search in each worker, in MB
+    num_threads : int, number of queries blocks searched in parallel by each worker
+    chunk_size : int, number of descriptors copied at a time into the shards
+    """
+
+    def __init__(self, database_descriptors, num_shards, memory_budget_mb=1024, num_threads=1, chunk_size=100000):
+        self.ntotal, self.d = database_descriptors.shape
+        self.memory_budget_mb = memory_budget_mb
+        self.num_threads = num_threads
+        omp_num_threads = max(1, (os.cpu_count() or 1) // num_shards)
+        context = multiprocessing.get_context("spawn")
+        self.shms, self.connections, self.processes = [], [], []
+        try:
+            for shard_start, shard_end in self.get_shards_bounds(num_shards):
+                shape = (shard_end - shard_start, self.d)
+                shm = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1] * 4))
+                self.shms.append(shm)
+                database_shard = np.ndarray(shape, dtype="float32", buffer=shm.buf)
+                # Copy in chunks, so that the database can be a np.memmap larger than RAM
+                for start in range(shard_start, shard_end, chunk_size):
+                    end = min(start + chunk_size, shard_end)
+                    database_shard[start - shard_start : end - shard_start] = database_descriptors[start:end]
+                del database_shard
+                connection, worker_connection = context.Pipe()
+                process = context.Process(
+                    target=_serve_shard,
+                    args=(worker_connection, shm.name, shape, shard_start, num_threads, omp_num_threads),
+                    daemon=True,
+                )
+                process.start()
+                worker_connection.close()
+                self.connections.append(connection)
+                self.processes.append(process)
+            # Wait for the workers to start, so that their startup time is not counted in the first search
+            for connection in self.connections:
+                connection.recv()
+        except BaseException:
+            self.close()
+            raise
+
+    def get_shards_bounds(self, num_shards):
+        """Return the (start, end) of each shard, i.e. contiguous ranges of database indices."""
+        bounds = np.linspace(0, self.ntotal, num_shards + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def search(self, queries_descriptors, k):
+        """Return (distances, predictions) of the k nearest neighbours of each query."""
+        queries_descriptors = np.ascontiguousarray(queries_descriptors, dtype="float32")
+        blocks_sizes = get_blocks_sizes(self.d, self.ntotal, k, self.memory_budget_mb, self.num_threads)
+        for connection in self.connections:
+            connection.send((queries_descriptors, k, blocks_sizes))
+        # Merge the shards in order, as search.search_block merges the blocks of the database
+        result_heap = faiss.ResultHeap(len(queries_descriptors), k)
+        results = [connection.recv() for connection in self.connections]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+            result_heap.add_result(*result)
+        result_heap.finalize()
+        return result_heap.D, result_heap.I
+
+    def close(self):
+        """Stop the workers and release the shared memory."""
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms, self.connections, self.processes = [], [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return f"< ShardedIndex; #shards: {len(self.processes)}; #database: {self.ntotal} >"
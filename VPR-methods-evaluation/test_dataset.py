@@ -1,18 +1,22 @@
 import os
-from glob import glob
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch.utils.data as data
 import torchvision.transforms as transforms
 from PIL import Image
-from sklearn.neighbors import NearestNeighbors
+
+from images_index import read_images_utms, scan_images_paths
+from positives import get_positives
 
 
 def read_images_paths(dataset_folder):
     """Find images within 'dataset_folder'. If the file
     'dataset_folder'_images_paths.txt exists, read paths from such file.
-    Otherwise, use glob(). Keeping the paths in the file speeds up computation,
-    because using glob over very large folders might be slow.
+    Otherwise, scan the folder. Keeping the paths in the file speeds up computation,
+    because scanning very large folders might be slow. The file can be created
+    with images_index.py.
 
     Parameters
     ----------
@@ -40,30 +44,107 @@ def read_images_paths(dataset_folder):
                 f"that the content of {file_with_paths} is wrong."
             )
     else:
-        print(f"Searching test images in {dataset_folder} with glob()")
-        images_paths = sorted(glob(f"{dataset_folder}/**/*", recursive=True))
-        images_paths = [p for p in images_paths if os.path.isfile(p) and os.path.splitext(p)[1].lower() in [".jpg", ".jpeg", ".png"]]
+        print(f"Searching test images in {dataset_folder} with os.scandir()")
+        images_paths = scan_images_paths(dataset_folder)
         if len(images_paths) == 0:
             raise FileNotFoundError(f"Directory {dataset_folder} does not contain any images")
     return images_paths
 
 
+def get_resized_size(w, h, image_size=None, size_multiple=None):
+    """Return the (H, W) that an image of size (w, h) has after resizing.
+
+    Parameters
+    ----------
+    w, h : int, original width and height of the image
+    image_size : list[int], (H, W) to resize images to, or the size of the
+        smallest edge if a single int is passed.
+    size_multiple : int, if set, height and width are rounded to the nearest
+        multiple of it.
+    """
+    if image_size and len(image_size) == 2:
+        h, w = image_size
+    elif image_size:
+        # Same computation as transforms.Resize when a single int is passed
+        short_side, long_side = (w, h) if w <= h else (h, w)
+        new_short, new_long = image_size[0], int(image_size[0] * long_side / short_side)
+        w, h = (new_short, new_long) if w <= h else (new_long, new_short)
+    if size_multiple:
+        h = round(h / size_multiple) * size_multiple
+        w = round(w / size_multiple) * size_multiple
+    return h, w
+
+
+def decode_resized_image(pil_img, image_hw):
+    """Decode an image close to the target resolution, using JPEG draft mode
+    (which decodes at 1/2, 1/4 or 1/8 scale) or Image.reduce(), and then resize
+    it to exactly image_hw while it is still uint8.
+
+    Parameters
+    ----------
+    pil_img : PIL.Image, opened but not yet decoded
+    image_hw : tuple(int, int), target (H, W)
+
+    Returns
+    -------
+    pil_img : PIL.Image in RGB mode with size image_hw
+    """
+    h, w = image_hw
+    if pil_img.size != (w, h):
+        # No-op for non-JPEG images. The decoded size is always >= the requested size
+        pil_img.draft("RGB", (w, h))
+    pil_img = pil_img.convert("RGB")
+    factor = min(pil_img.width // w, pil_img.height // h)
+    if factor > 1:
+        pil_img = pil_img.reduce(factor)
+    if pil_img.size != (w, h):
+        pil_img = pil_img.resize((w, h), Image.Resampling.BILINEAR)
+    return pil_img
+
+
 class TestDataset(data.Dataset):
-    def __init__(self, database_folder, queries_folder, positive_dist_threshold=25, image_size=None, use_labels=True):
+    def __init__(
+        self,
+        database_folder,
+        queries_folder,
+        positive_dist_threshold=25,
+        image_size=None,
+        use_labels=True,
+        size_multiple=None,
+        fast_decode=False,
+        image_shards_dir=None,
+        positives_cache_dir=None,
+    ):
         """Dataset with images from database and queries, used for validation and test.
         Parameters
         ----------
         dataset_folder : str, should contain the path to the val or test set,
             which contains the folders {database_folder} and {queries_folder}.
         database_folder : str, name of folder with the database.
-        queries_folder : str, name of folder with the queries.
-        positive_dist_threshold : int, distance in meters for a prediction to
-            be considered a positive.
+        queries_folder : str, name of folder with the queries, or None to
+            only load the database (e.g. to serve queries with server.py).
+        positive_dist_threshold : int or list[int], distance in meters for a
+            prediction to be considered a positive. If a list is passed,
+            positives are computed for each threshold.
+        image_size : list[int], (H, W) to resize images to, or the size of the
+            smallest edge if a single int is passed.
+        size_multiple : int, if set, height and width are rounded to the
+            nearest multiple of it (e.g. 14 for DINOv2 based models).
+        fast_decode : bool, if True decode JPEGs at reduced resolution and
+            resize in uint8 before normalization, instead of resizing the
+            normalized float tensor.
+        image_shards_dir : str, if set, read the images from the shards of
+            pre-decoded images within this folder (see image_shards.py),
+            building them if they don't exist yet. With fast_decode they are
+            stored resized, otherwise at their original resolution, and they
+            are resized when read as without shards.
+        positives_cache_dir : str, if set, positives are saved within this
+            folder and read from it in later runs with the same UTMs.
         """
         super().__init__()
 
         self.database_paths = read_images_paths(database_folder)
-        self.queries_paths = read_images_paths(queries_folder)
+        self.queries_paths = read_images_paths(queries_folder) if queries_folder is not None else []
 
         self.images_paths = list(self.database_paths) + list(self.queries_paths)
 
@@ -84,33 +165,77 @@ class TestDataset(data.Dataset):
                     f"but it is {image_path}, which does not contain the UTM coordinates."
                 )
 
-            self.database_utms = np.array(
-                [(path.split("@")[1], path.split("@")[2]) for path in self.database_paths]
-            ).astype(float)
-            self.queries_utms = np.array(
-                [(path.split("@")[1], path.split("@")[2]) for path in self.queries_paths]
-            ).astype(float)
-
-            # Find positives_per_query, which are within positive_dist_threshold (default 25 meters)
-            knn = NearestNeighbors(n_jobs=-1)
-            knn.fit(self.database_utms)
-            self.positives_per_query = knn.radius_neighbors(
-                self.queries_utms, radius=positive_dist_threshold, return_distance=False
+            # Use the UTMs precomputed by images_index.py if available
+            self.database_utms = read_images_utms(database_folder, self.database_paths)
+            if self.database_utms is None:
+                self.database_utms = np.array(
+                    [(path.split("@")[1], path.split("@")[2]) for path in self.database_paths]
+                ).astype(float)
+            self.queries_utms = read_images_utms(queries_folder, self.queries_paths)
+            if self.queries_utms is None:
+                self.queries_utms = np.array(
+                    [(path.split("@")[1], path.split("@")[2]) for path in self.queries_paths]
+                ).astype(float)
+
+            # Find positives_per_query, which are within positive_dist_threshold (default 25 meters).
+            # When multiple thresholds are passed, they are all computed at once, and the first one is the default
+            if isinstance(positive_dist_threshold, (int, float)):
+                positive_dist_threshold = [positive_dist_threshold]
+            self.positive_dist_thresholds = list(positive_dist_threshold)
+            self.positives_per_threshold = get_positives(
+                self.database_utms, self.queries_utms, self.positive_dist_thresholds, cache_dir=positives_cache_dir
             )
+            self.positives_per_query = self.positives_per_threshold[self.positive_dist_thresholds[0]]
 
-        transformations = [
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ]
-        if image_size:
-            transformations.append(transforms.Resize(size=image_size, antialias=True))
-        self.transform = transforms.Compose(transformations)
+        self.transform = transforms.Compose(
+            [
+                transforms.ToTensor(),
+                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            ]
+        )
+        self.image_size = image_size
+        self.size_multiple = size_multiple
+        self.fast_decode = fast_decode
+        self.image_shards = None
+        if image_shards_dir:
+            from image_shards import get_image_shards
+
+            self.image_shards = [
+                get_image_shards(image_shards_dir, folder, paths, image_size, size_multiple, fast_decode)
+                for folder, paths in [(database_folder, self.database_paths), (queries_folder, self.queries_paths)]
+                if folder is not None
+            ]
 
     def __getitem__(self, index):
+        if self.image_shards is not None:
+            if index < self.num_database:
+                image = self.image_shards[0][index]
+            else:
+                image = self.image_shards[1][index - self.num_database]
+            if self.fast_decode:
+                # Images within the shards are already resized
+                return self.transform(image), index
+            return self.normalize_and_resize(image), index
         image_path = self.images_paths[index]
-        pil_img = Image.open(image_path).convert("RGB")
-        normalized_img = self.transform(pil_img)
-        return normalized_img, index
+        pil_img = Image.open(image_path)
+        return self.preprocess_image(pil_img), index
+
+    def preprocess_image(self, pil_img):
+        """Resize and normalize a PIL image as the images of the dataset."""
+        if self.fast_decode:
+            image_hw = get_resized_size(*pil_img.size, self.image_size, self.size_multiple)
+            return self.transform(decode_resized_image(pil_img, image_hw))
+        return self.normalize_and_resize(pil_img.convert("RGB"))
+
+    def normalize_and_resize(self, image):
+        """Normalize a decoded image (PIL image or uint8 np.array of shape (H, W, 3)),
+        and resize the normalized tensor."""
+        normalized_img = self.transform(image)
+        h, w = normalized_img.shape[-2:]
+        image_hw = get_resized_size(w, h, self.image_size, self.size_multiple)
+        if image_hw != (h, w):
+            normalized_img = transforms.functional.resize(normalized_img, list(image_hw), antialias=True)
+        return normalized_img
 
     def __len__(self):
         return len(self.images_paths)
@@ -118,5 +243,57 @@ class TestDataset(data.Dataset):
     def __repr__(self):
         return f"< #queries: {self.num_queries}; #database: {self.num_database} >"
 
-    def get_positives(self):
-        return self.positives_per_query
+    def get_positives(self, dist_threshold=None):
+        """Return the positives of each query (as a positives.Positives) within
+        dist_threshold, which defaults to the first positive_dist_threshold."""
+        if dist_threshold is None:
+            return self.positives_per_query
+        return self.positives_per_threshold[dist_threshold]
+
+    def get_image_size(self, index):
+        """Return the (H, W) that the image at 'index' has after resizing,
+        reading only the image header instead of decoding the whole image."""
+        if self.image_size and len(self.image_size) == 2:
+            return get_resized_size(None, None, self.image_size, self.size_multiple)
+        if self.image_shards is not None:
+            if index < self.num_database:
+                h, w = self.image_shards[0].get_image_size(index)
+            else:
+                h, w = self.image_shards[1].get_image_size(index - self.num_database)
+            # With fast_decode images within the shards are already resized
+            return (h, w) if self.fast_decode else get_resized_size(w, h, self.image_size, self.size_multiple)
+        with Image.open(self.images_paths[index]) as pil_img:
+            w, h = pil_img.size
+        return get_resized_size(w, h, self.image_size, self.size_multiple)
+
+
+class BucketBatchSampler(data.Sampler):
+    """Batch sampler that groups the images of a TestDataset by their (H, W)
+    after resizing, so that batches never contain images of different shapes
+    and full batches can be used also when resolutions differ.
+
+    Parameters
+    ----------
+    dataset : TestDataset
+    indices : iterable of int, indices of the dataset to sample from
+    batch_size : int
+    num_threads : int, threads used to read the images headers
+    """
+
+    def __init__(self, dataset, indices, batch_size, num_threads=8):
+        indices = list(indices)
+        with ThreadPoolExecutor(num_threads) as executor:
+            images_sizes = list(executor.map(dataset.get_image_size, indices))
+        buckets = defaultdict(list)
+        for index, image_size in zip(indices, images_sizes):
+            buckets[image_size].append(index)
+        self.batches = [
+            bucket[i : i + batch_size] for bucket in buckets.values() for i in range(0, len(bucket), batch_size)
+        ]
+        self.num_buckets = len(buckets)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
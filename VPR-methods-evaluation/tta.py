@@ -0,0 +1,97 @@
+"""Test-time augmentation (TTA) with multiple scales and horizontal flips.
+All the views of an image are generated from a single decoding, within the
+dataloader worker, and the views of a batch are collated into one tensor per
+scale (original and flipped images stacked together), so that each forward
+pass processes a full batch. The descriptors of the views are then pooled
+like dirtorch.utils.common.pool, and L2-normalized.
+"""
+
+import torch
+from torch.utils import data
+from torchvision import transforms
+
+
+def get_scaled_size(h, w, scale, size_multiple=None):
+    """Return the (H, W) of an image of size (h, w) rescaled by scale, rounded
+    to a multiple of size_multiple (if set)."""
+    multiple = size_multiple or 1
+    return tuple(max(multiple, round(side * scale / multiple) * multiple) for side in (h, w))
+
+
+class TTADataset(data.Dataset):
+    """Wrap a TestDataset so that each item is the list of views of an image,
+    i.e. for each scale the rescaled image followed (if flip) by its flipped copy.
+
+    Parameters
+    ----------
+    dataset : TestDataset
+    scales : list[float], scales relative to the size of the images in dataset
+    flip : bool, whether to add the horizontally flipped views
+    size_multiple : int, the sizes of the views are rounded to a multiple of it
+    """
+
+    def __init__(self, dataset, scales=(1,), flip=False, size_multiple=None):
+        self.dataset = dataset
+        self.scales = list(scales)
+        self.flip = flip
+        self.size_multiple = size_multiple
+
+    def __getitem__(self, index):
+        image, index = self.dataset[index]
+        h, w = image.shape[-2:]
+        views = []
+        for scale in self.scales:
+            scaled_hw = get_scaled_size(h, w, scale, self.size_multiple)
+            scaled_image = image
+            if scaled_hw != (h, w):
+                scaled_image = transforms.functional.resize(image, list(scaled_hw), antialias=True)
+            views.append(scaled_image)
+            if self.flip:
+                views.append(torch.flip(scaled_image, dims=[-1]))
+        return views, index
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @property
+    def num_views_per_scale(self):
+        return 2 if self.flip else 1
+
+
+def collate_views(batch, num_views_per_scale=1):
+    """Collate a batch of TTADataset items into a list with one tensor per scale,
+    of shape [(num_views_per_scale * batch_size) x 3 x H x W], where the views are
+    ordered by view and then by image, and a tensor with the indices."""
+    views_per_image, indices = zip(*batch)
+    num_views = len(views_per_image[0])
+    images_per_scale = []
+    for first_view in range(0, num_views, num_views_per_scale):
+        images_per_scale.append(
+            torch.stack(
+                [
+                    views[view]
+                    for view in range(first_view, first_view + num_views_per_scale)
+                    for views in views_per_image
+                ]
+            )
+        )
+    return images_per_scale, torch.tensor(indices)
+
+
+def pool_descriptors(descriptors, pooling="mean", gem_p=3):
+    """Pool the descriptors of the views of each image, and L2-normalize them.
+
+    Parameters
+    ----------
+    descriptors : torch.Tensor of shape [num_views x batch_size x dim]
+    pooling : str, "mean" or "gem" (generalized mean with exponent gem_p,
+        applied to the absolute values keeping the signs, as dirtorch's sympow)
+    """
+    if pooling == "mean":
+        pooled = descriptors.mean(dim=0)
+    elif pooling == "gem":
+        signed_pow = lambda x, p: x.abs().clamp(min=1e-6).pow(p) * x.sign()
+        pooled = signed_pow(signed_pow(descriptors, gem_p).mean(dim=0), 1 / gem_p)
+    else:
+        raise ValueError(f"pooling must be mean or gem, not {pooling}")
+    return torch.nn.functional.normalize(pooled, p=2, dim=-1)
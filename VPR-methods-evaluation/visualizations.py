@@ -113,6 +113,8 @@ def save_preds(predictions, eval_ds, log_dir, save_only_wrong_preds=None, use_la
         # List of None (query), True (correct preds) or False (wrong preds)
         preds_correct = [None]
         for pred_index, pred in enumerate(preds):
+            if pred < 0:
+                continue  # Missing prediction, e.g. when few database images are within the geographic prior
             pred_path = eval_ds.database_paths[pred]
             list_of_images_paths.append(pred_path)
             if use_labels:
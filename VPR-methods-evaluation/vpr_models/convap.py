@@ -104,13 +104,17 @@ class ResNet(nn.Module):
 
 
 class ConvAPModel(torch.nn.Module):
+    # Input size of the model, declared so that the dataloader resizes images only once
+    input_size = (320, 320)
+
     def __init__(self, agg_config={}):
         super().__init__()
         self.backbone = ResNet()
         self.aggregator = ConvAP(**agg_config)
 
     def forward(self, x):
-        x = transforms.Resize([320, 320])(x)
+        if tuple(x.shape[-2:]) != self.input_size:
+            x = transforms.Resize(list(self.input_size))(x)
         x = self.backbone(x)
         x = self.aggregator(x)
         return x
@@ -117,13 +117,17 @@ class ResNet(nn.Module):
 
 
 class MixVPRModel(torch.nn.Module):
+    # Images are resized to this size in forward(), so the dataloader can directly resize them to it
+    input_size = (320, 320)
+
     def __init__(self, agg_config={}):
         super().__init__()
         self.backbone = ResNet()
         self.aggregator = MixVPR(**agg_config)
 
     def forward(self, x):
-        x = transforms.Resize([320, 320], antialias=True)(x)
+        if tuple(x.shape[-2:]) != self.input_size:
+            x = transforms.Resize(list(self.input_size), antialias=True)(x)
         x = self.backbone(x)
         x = self.aggregator(x)
         return x
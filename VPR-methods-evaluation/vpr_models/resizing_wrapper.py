@@ -11,16 +11,21 @@ class ResizingWrapper(torch.nn.Module):
         super().__init__()
         self.model = model
         self.resize_type = resize_type
+        # Declare the input size, so that the dataloader can directly resize images
+        # to it, and the resizing in forward() becomes a no-op
+        self.input_size = (resize_type, resize_type) if isinstance(resize_type, int) else None
+        self.input_size_multiple = 14 if resize_type == "dino_v2_resize" else None
 
     def forward(self, images):
         if self.resize_type == "dino_v2_resize":
             b, c, h, w = images.shape
             # DINO wants height and width as multiple of 14, therefore resize them
             # to the nearest multiple of 14
-            h = round(h / 14) * 14
-            w = round(w / 14) * 14
-            images = transforms.functional.resize(images, [h, w], antialias=True)
-        if isinstance(self.resize_type, int):
+            new_h = round(h / 14) * 14
+            new_w = round(w / 14) * 14
+            if (new_h, new_w) != (h, w):
+                images = transforms.functional.resize(images, [new_h, new_w], antialias=True)
+        if isinstance(self.resize_type, int) and tuple(images.shape[-2:]) != self.input_size:
             img_size = self.resize_type
             images = transforms.functional.resize(images, [img_size, img_size], antialias=True)
         return self.model(images)
@@ -0,0 +1,55 @@
+"""PCA-whitening of descriptors, to reduce their dimension before indexing.
+The projection is fitted on (a sample of) the database descriptors, with each
+principal component scaled by the inverse square root of its eigenvalue, and
+the projected descriptors are L2-normalized, as in dirtorch.utils.common.whiten_features.
+"""
+
+import os
+
+import faiss
+import numpy as np
+
+from indexes import sample_descriptors
+
+
+def fit_pca_whitening(database_descriptors, pca_dim, train_size=100000, seed=0):
+    """Fit a PCA-whitening from database_descriptors.shape[1] to pca_dim
+    dimensions on a random sample of train_size database descriptors."""
+    pca = faiss.PCAMatrix(database_descriptors.shape[1], pca_dim, -0.5)
+    pca.train(sample_descriptors(database_descriptors, train_size, seed))
+    return pca
+
+
+def apply_pca_whitening(pca, descriptors, chunk_size=100000):
+    """Project descriptors (possibly a np.memmap larger than RAM) in chunks,
+    and L2-normalize them.
+
+    Returns
+    -------
+    whitened_descriptors : np.array of float32 of shape [len(descriptors) x pca.d_out]
+    """
+    whitened_descriptors = np.empty((len(descriptors), pca.d_out), dtype="float32")
+    for start in range(0, len(descriptors), chunk_size):
+        chunk = pca.apply(np.ascontiguousarray(descriptors[start : start + chunk_size], dtype="float32"))
+        faiss.normalize_L2(chunk)
+        whitened_descriptors[start : start + chunk_size] = chunk
+    return whitened_descriptors
+
+
+def load_or_fit_pca_whitening(pca_path, database_descriptors, pca_dim, train_size=100000):
+    """Read the PCA-whitening from pca_path if it exists and matches the
+    dimensions, otherwise fit it and write it to pca_path.
+
+    Returns
+    -------
+    pca : faiss.PCAMatrix
+    loaded : bool, True if the PCA-whitening was read from pca_path
+    """
+    if os.path.exists(pca_path):
+        pca = faiss.read_VectorTransform(str(pca_path))
+        if pca.d_in == database_descriptors.shape[1] and pca.d_out == pca_dim:
+            return pca, True
+    pca = fit_pca_whitening(database_descriptors, pca_dim, train_size)
+    os.makedirs(os.path.dirname(os.path.abspath(pca_path)), exist_ok=True)
+    faiss.write_VectorTransform(pca, str(pca_path))
+    return pca, False
@@ -1,9 +1,14 @@
 import os
+import sys
 import torch
 import numpy as np
 from sklearn.metrics import precision_recall_curve, auc, roc_auc_score, average_precision_score
 import re
 
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "VPR-methods-evaluation"))
+
+from evaluation import get_correct_matrix, get_first_correct_rank
+
 # === 配置路径 ===
 LOG_DIR = r"D:\AML\Visual-Place-Recognition-Project\logs\log_dir\2025-12-07_19-13-12"
 Z_DATA_PATH = os.path.join(LOG_DIR, "z_data.torch")
@@ -28,24 +33,12 @@ def calculate_metrics():
     # === PART 1: 计算标准 VPR Recall@N ===
     print("\n📊 Calculating Standard VPR Recall@N...")
     
-    recalls = {1: [], 5: [], 10: [], 20: []}
-    
-    # 遍历每个查询
-    for i in range(len(predictions)):
-        # 获取该查询的 Top-K 预测 (通常 K=20)
-        preds = predictions[i]
-        if isinstance(preds, torch.Tensor):
-            preds = preds.tolist()
-            
-        true_matches = positives[i] # 该查询对应的真实正确索引列表
-        
-        # 检查 Top-N 是否命中
-        for n in recalls.keys():
-            # 取前 N 个预测
-            top_n = preds[:n]
-            # 判断是否有任意一个在 true_matches 里
-            hit = any(p in true_matches for p in top_n)
-            recalls[n].append(1 if hit else 0)
+    if isinstance(predictions, torch.Tensor):
+        predictions = predictions.numpy()
+
+    # 一次性计算所有查询的第一个正确预测的排名
+    first_correct_rank = get_first_correct_rank(get_correct_matrix(predictions, positives))
+    recalls = {n: (first_correct_rank < n).astype(int).tolist() for n in [1, 5, 10, 20]}
 
     # 输出 Recall 结果
     print("-" * 30)
@@ -0,0 +1,78 @@
+import torch
+import torch.nn.functional as F
+
+
+def get_batch_lightglue(matcher):
+    """Return the LightGlue model of a detector-based matcher, or None if its pairs
+    can't be matched in batches with the same results as one pair at a time."""
+    try:
+        from lightglue import LightGlue
+    except ImportError:
+        return None
+    lightglue = getattr(matcher, "matcher", None)
+    if not isinstance(lightglue, LightGlue):
+        return None
+    # With adaptive depth and width each pair stops at its own layer and prunes its own keypoints
+    if lightglue.conf.depth_confidence > 0 or lightglue.conf.width_confidence > 0:
+        return None
+    return lightglue
+
+
+def get_keypoints(lightglue, feats):
+    from lightglue.lightglue import normalize_keypoints
+
+    kpts = normalize_keypoints(feats["keypoints"], feats.get("image_size")).clone()
+    if lightglue.conf.add_scale_ori:
+        kpts = torch.cat([kpts] + [feats[k].unsqueeze(-1) for k in ("scales", "oris")], -1)
+    return kpts
+
+
+def pad_keypoints(x, length):
+    """Pad x, with shape [1, num_kpts, dim], with zeros to [1, length, dim]."""
+    return F.pad(x, (0, 0, 0, length - x.shape[1]))
+
+
+@torch.inference_mode()
+def match_features_batch(lightglue, feats0, feats1_list):
+    """Match the features of an image with each of feats1_list in a single forward pass of LightGlue.
+    The keypoints of feats1_list are padded to the same number, and the padded ones are masked in the
+    attention layers, so that the matches are the same as from matching each pair on its own.
+    Return a list with the matches of each pair, with shape [num_matches, 2]."""
+    from lightglue.lightglue import filter_matches
+
+    with torch.autocast(enabled=lightglue.conf.mp, device_type="cuda"):
+        batch_size = len(feats1_list)
+        nums_kpts1 = [feats1["keypoints"].shape[1] for feats1 in feats1_list]
+        max_kpts1 = max(nums_kpts1)
+        device = feats0["keypoints"].device
+        no_matches = feats0["keypoints"].new_zeros((0, 2), dtype=torch.long)
+        if feats0["keypoints"].shape[1] == 0 or max_kpts1 == 0:
+            return [no_matches] * batch_size
+
+        kpts0 = get_keypoints(lightglue, feats0).expand(batch_size, -1, -1)
+        kpts1 = torch.cat([pad_keypoints(get_keypoints(lightglue, feats1), max_kpts1) for feats1 in feats1_list])
+        desc0 = feats0["descriptors"].detach().expand(batch_size, -1, -1).contiguous()
+        desc1 = torch.cat([pad_keypoints(feats1["descriptors"].detach(), max_kpts1) for feats1 in feats1_list])
+        if torch.is_autocast_enabled():
+            desc0, desc1 = desc0.half(), desc1.half()
+        desc0, desc1 = lightglue.input_proj(desc0), lightglue.input_proj(desc1)
+        encoding0, encoding1 = lightglue.posenc(kpts0), lightglue.posenc(kpts1)
+
+        # Masks with shape [batch_size, 1, num_kpts, 1], the second dimension being broadcast to the attention heads
+        mask0 = torch.ones(batch_size, 1, kpts0.shape[1], 1, dtype=torch.bool, device=device)
+        mask1 = torch.arange(max_kpts1, device=device)[None] < torch.tensor(nums_kpts1, device=device)[:, None]
+        mask1 = mask1[:, None, :, None]
+        for layer in lightglue.transformers:
+            desc0, desc1 = layer(desc0, desc1, encoding0, encoding1, mask0=mask0, mask1=mask1)
+
+        # The assignment is computed without the padded keypoints, as their scores would change the normalization
+        matches = []
+        for i, num_kpts1 in enumerate(nums_kpts1):
+            if num_kpts1 == 0:
+                matches.append(no_matches)
+                continue
+            scores, _ = lightglue.log_assignment[-1](desc0[i : i + 1], desc1[i : i + 1, :num_kpts1])
+            m0 = filter_matches(scores, lightglue.conf.filter_threshold)[0][0]
+            valid = m0 > -1
+            matches.append(torch.stack([torch.where(valid)[0], m0[valid]], -1))
+        return matches
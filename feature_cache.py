@@ -0,0 +1,40 @@
+import os
+import hashlib
+import torch
+from pathlib import Path
+
+
+class FeatureCache:
+    """On-disk cache of the local features (keypoints, descriptors, ...) of images,
+    as returned by the extractor of a detector-based matcher (e.g. sift-lg).
+    Features are saved in one file per image, within a folder per (extractor, im_size)."""
+
+    def __init__(self, cache_dir, extractor_name, im_size):
+        self.folder = Path(cache_dir).joinpath(f"{extractor_name}_{im_size}")
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.num_hits = self.num_misses = 0
+
+    def get_path(self, image_path):
+        key = hashlib.sha1(os.path.abspath(image_path).encode()).hexdigest()
+        return self.folder.joinpath(key[:2], f"{key}.torch")
+
+    def load(self, image_path):
+        """Return the features of image_path, or None if they are not in the cache."""
+        path = self.get_path(image_path)
+        if not path.exists():
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        return torch.load(path, weights_only=True)
+
+    def save(self, image_path, features):
+        path = self.get_path(image_path)
+        path.parent.mkdir(exist_ok=True)
+        # Written to a temporary file and renamed, so that processes matching
+        # other queries never read partially written features
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        torch.save({k: v.cpu() for k, v in features.items()}, tmp_path)
+        os.replace(tmp_path, path)
+
+    def __repr__(self):
+        return f"< FeatureCache in {self.folder}; hits: {self.num_hits}; misses: {self.num_misses} >"
@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ImagePrefetcher:
+    """Decode images in a pool of threads ahead of their use, so that the matcher
+    doesn't wait for the decoding, and keep the decoded images in a bounded LRU
+    cache, so that images retrieved by multiple queries are decoded only once.
+    max_images should be larger than the number of images used by two queries,
+    otherwise prefetching the next query evicts the images of the current one."""
+
+    def __init__(self, load_image, max_images=256, num_threads=4):
+        self.load_image = load_image
+        self.max_images = max_images
+        self.executor = ThreadPoolExecutor(num_threads)
+        # Futures of the decoded images, from the least to the most recently used
+        self.images = OrderedDict()
+        self.num_hits = self.num_misses = self.num_decoded = 0
+        self.wait_time = 0
+
+    def _submit(self, path):
+        self.num_decoded += 1
+        self.images[path] = self.executor.submit(self.load_image, path)
+        while len(self.images) > self.max_images:
+            self.images.popitem(last=False)
+
+    def prefetch(self, paths):
+        """Start decoding the images of paths which are not already cached."""
+        for path in paths:
+            if path in self.images:
+                self.images.move_to_end(path)
+            else:
+                self._submit(path)
+
+    def get(self, path):
+        """Return the decoded image, waiting for it if it is still being decoded."""
+        if path in self.images:
+            self.num_hits += 1
+            self.images.move_to_end(path)
+        else:
+            self.num_misses += 1
+            self._submit(path)
+        start_time = time.perf_counter()
+        image = self.images[path].result()
+        self.wait_time += time.perf_counter() - start_time
+        return image
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __repr__(self):
+        hit_rate = self.num_hits / max(self.num_hits + self.num_misses, 1)
+        return (
+            f"< ImagePrefetcher; hits: {self.num_hits}; misses: {self.num_misses}; hit rate: {hit_rate:.1%}; "
+            f"decoded images: {self.num_decoded}; time waiting for decoding: {self.wait_time:.1f} s >"
+        )
@@ -0,0 +1,57 @@
+import os
+import pickle
+import sqlite3
+
+
+class MatchCache:
+    """Persistent cache of the results of matching (query, database image) pairs,
+    shared by the runs on the predictions of different VPR methods, which retrieve
+    many of the same pairs. All pairs are kept in a single SQLite database, indexed
+    by (matcher, im_size, query path, database image path)."""
+
+    def __init__(self, db_path, matcher_name, im_size):
+        self.db_path = db_path
+        self.matcher_name = matcher_name
+        self.im_size = im_size
+        self.num_hits = self.num_misses = 0
+        # A long timeout, as multiple processes (e.g. on different query ranges) can write at the same time
+        self.connection = sqlite3.connect(db_path, timeout=600)
+        # With WAL journaling readers don't block the writer, and vice versa
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pairs (matcher TEXT, im_size INTEGER, query_path TEXT, db_path TEXT, "
+            "result BLOB, PRIMARY KEY (matcher, im_size, query_path, db_path)) WITHOUT ROWID"
+        )
+        self.connection.commit()
+
+    def get(self, query_path, db_paths):
+        """Return a dict with the cached results of the pairs of query_path with db_paths."""
+        rows = self.connection.execute(
+            "SELECT db_path, result FROM pairs WHERE matcher = ? AND im_size = ? AND query_path = ?",
+            (self.matcher_name, self.im_size, os.path.abspath(query_path)),
+        )
+        abs_paths = {os.path.abspath(path): path for path in db_paths}
+        results = {abs_paths[db_path]: pickle.loads(result) for db_path, result in rows if db_path in abs_paths}
+        self.num_hits += len(results)
+        self.num_misses += len(set(db_paths)) - len(results)
+        return results
+
+    def put(self, query_path, results):
+        """Save results, a dict with the results of the pairs of query_path with each database image path."""
+        query_path = os.path.abspath(query_path)
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?)",
+            [
+                (self.matcher_name, self.im_size, query_path, os.path.abspath(db_path), pickle.dumps(result, protocol=4))
+                for db_path, result in results.items()
+            ],
+        )
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM pairs WHERE matcher = ? AND im_size = ?", (self.matcher_name, self.im_size)
+        ).fetchone()[0]
+
+    def __repr__(self):
+        return f"< MatchCache in {self.db_path}; hits: {self.num_hits}; misses: {self.num_misses} >"
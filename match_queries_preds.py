@@ -1,14 +1,18 @@
-
 import os
 import sys
 import argparse
 import torch
+import numpy as np
 from glob import glob
 from tqdm import tqdm
 from pathlib import Path
 from copy import deepcopy
 
 from util import read_file_preds
+from feature_cache import FeatureCache
+from match_cache import MatchCache
+from image_prefetcher import ImagePrefetcher
+from batch_matching import get_batch_lightglue, match_features_batch
 
 import ssl
 ssl._create_default_https_context = ssl._create_unverified_context
@@ -16,9 +20,9 @@ ssl._create_default_https_context = ssl._create_unverified_context
 sys.path.append(str(Path(__file__).parent.joinpath("image-matching-models")))
 
 from matching import get_matcher, available_models
-from matching.utils import get_default_device
+from matching.utils import get_default_device, to_numpy
 
-def parse_arguments():
+def get_parser():
     parser = argparse.ArgumentParser()
     
     parser.add_argument("--preds-dir", type=str, help="directory with predictions of a VPR model")
@@ -36,42 +40,232 @@ def parse_arguments():
     parser.add_argument("--num-preds", type=int, default=100, help="number of predictions to match")
     parser.add_argument("--start-query", type=int, default=-1, help="query to start from")
     parser.add_argument("--num-queries", type=int, default=-1, help="number of queries")
+    parser.add_argument(
+        "--features-cache-dir",
+        type=str,
+        default=None,
+        help="directory where the local features of each image are cached, for detector-based matchers "
+        "(e.g. sift-lg, superpoint-lg), so that each image is described only once across queries and runs",
+    )
+    parser.add_argument(
+        "--match-cache",
+        type=str,
+        default=None,
+        help="path of an SQLite file where the results of each (query, prediction) pair are cached, so that "
+        "runs on the predictions of other VPR methods only match the pairs that were not matched before",
+    )
+    parser.add_argument(
+        "--prefetch-threads",
+        type=int,
+        default=4,
+        help="threads decoding the images of the next query while the current one is matched (0 to disable)",
+    )
+    parser.add_argument(
+        "--image-cache-size",
+        type=int,
+        default=256,
+        help="number of decoded images kept in memory, so that images retrieved by multiple queries are "
+        "decoded once. It should be larger than 2 * (num-preds + 1)",
+    )
+    parser.add_argument(
+        "--match-batch-size",
+        type=int,
+        default=1,
+        help="number of predictions matched with their query in a single forward pass of LightGlue, for "
+        "detector-based matchers without adaptive depth and width (i.e. depth and width confidence set to -1)",
+    )
 
-    return parser.parse_args()
+    return parser
 
-def main(args):
-    device = args.device
-    matcher_name = args.matcher
-    img_size = args.im_size
-    num_preds = args.num_preds
-    matcher = get_matcher(matcher_name, device=device)
-    preds_folder = args.preds_dir
-    start_query = args.start_query
-    num_queries = args.num_queries
-
-    output_folder = Path(preds_folder + f"_{matcher_name}") if args.out_dir is None else Path(args.out_dir)
-    output_folder.mkdir(exist_ok=True)
-    
-    txt_files = glob(os.path.join(preds_folder, "*.txt"))
+def parse_arguments():
+    return get_parser().parse_args()
+
+def has_extractor(matcher):
+    # Detector-based matchers (e.g. sift-lg, superpoint-lg) extract the features of each image with
+    # their extractor, and then match them with LightGlue. Other matchers with an extractor (e.g. the
+    # SphereGlue ones) take other inputs, so they are run on each pair of images with matcher(img0, img1)
+    try:
+        from lightglue import LightGlue
+    except ImportError:
+        return False
+    return hasattr(matcher, "extractor") and isinstance(getattr(matcher, "matcher", None), LightGlue)
+
+def remove_batch_dim(data):
+    # Same as lightglue.utils.rbd: LightGlue returns the matches of each image of the batch in a list
+    return {k: v[0] if isinstance(v, (torch.Tensor, np.ndarray, list)) else v for k, v in data.items()}
+
+@torch.inference_mode()
+def extract_features(matcher, img_path, load_image, feature_cache=None):
+    features = feature_cache.load(img_path) if feature_cache is not None else None
+    if features is None:
+        img = load_image(img_path).to(matcher.device)
+        features = matcher.extractor.extract(img)
+        features = {k: v for k, v in features.items() if isinstance(v, torch.Tensor)}
+        if feature_cache is not None:
+            feature_cache.save(img_path, features)
+    return {k: v.to(matcher.device) for k, v in features.items()}
+
+@torch.inference_mode()
+def match_features(matcher, feats0, feats1, matches=None):
+    """Same as matcher(img0, img1) for detector-based matchers, from the features of the two images,
+    and optionally their matches if they were already computed (e.g. by match_features_batch)."""
+    if matches is None:
+        matches = remove_batch_dim(matcher.matcher({"image0": feats0, "image1": feats1}))["matches"]
+    kpts0, kpts1 = feats0["keypoints"][0], feats1["keypoints"][0]
+    matched_kpts0, matched_kpts1 = to_numpy(kpts0[matches[..., 0]]), to_numpy(kpts1[matches[..., 1]])
+    H, inlier_kpts0, inlier_kpts1 = matcher.process_matches(matched_kpts0, matched_kpts1)
+    return {
+        "num_inliers": len(inlier_kpts0),
+        "H": H,
+        "all_kpts0": to_numpy(kpts0),
+        "all_kpts1": to_numpy(kpts1),
+        "all_desc0": None,
+        "all_desc1": None,
+        "matched_kpts0": matched_kpts0,
+        "matched_kpts1": matched_kpts1,
+        "inlier_kpts0": inlier_kpts0,
+        "inlier_kpts1": inlier_kpts1,
+    }
+
+def match_pairs(
+    matcher, q_path, pred_paths, load_image, use_features, feature_cache=None, batch_lightglue=None, batch_size=1
+):
+    """Return a dict with the result of matching q_path with each of pred_paths. If batch_lightglue
+    is given, the predictions are matched with LightGlue in batches of batch_size."""
+    results = {}
+    if len(pred_paths) == 0:
+        return results
+    if use_features:
+        # The features of each image are extracted once, and only the matching runs for each pair
+        feats0 = extract_features(matcher, q_path, load_image, feature_cache)
+        all_feats1 = {path: extract_features(matcher, path, load_image, feature_cache) for path in pred_paths}
+        if batch_lightglue is None:
+            for pred_path, feats1 in all_feats1.items():
+                results[pred_path] = match_features(matcher, feats0, feats1)
+        else:
+            # Images with a similar number of keypoints are batched together, to reduce the padding
+            sorted_paths = sorted(all_feats1, key=lambda path: all_feats1[path]["keypoints"].shape[1])
+            for i in range(0, len(sorted_paths), batch_size):
+                batch_paths = sorted_paths[i : i + batch_size]
+                batch_feats1 = [all_feats1[pred_path] for pred_path in batch_paths]
+                batch_matches = match_features_batch(batch_lightglue, feats0, batch_feats1)
+                for pred_path, feats1, matches in zip(batch_paths, batch_feats1, batch_matches):
+                    results[pred_path] = match_features(matcher, feats0, feats1, matches)
+    else:
+        img0 = load_image(q_path)
+        for pred_path in pred_paths:
+            # Decoded images can be reused by other queries, so the matcher gets copies of them
+            result = matcher(deepcopy(img0), deepcopy(load_image(pred_path)))
+            result["all_desc0"] = result["all_desc1"] = None
+            results[pred_path] = result
+    return results
+
+def get_output_folder(args):
+    return Path(args.preds_dir + f"_{args.matcher}") if args.out_dir is None else Path(args.out_dir)
+
+def get_txt_files(args):
+    """Return the prediction files of the queries selected by --start-query and --num-queries."""
+    txt_files = glob(os.path.join(args.preds_dir, "*.txt"))
     txt_files.sort(key=lambda x: int(Path(x).stem))
+    start_query = args.start_query if args.start_query >= 0 else 0
+    num_queries = args.num_queries if args.num_queries >= 0 else len(txt_files)
+    return txt_files[start_query : start_query + num_queries]
+
+class QueriesMatcher:
+    """The matcher and the caches used to match the queries with their predictions."""
 
-    start_query = start_query if start_query >= 0 else 0
-    num_queries = num_queries if num_queries >= 0 else len(txt_files)
+    def __init__(self, args):
+        self.num_preds = args.num_preds
+        self.matcher = get_matcher(args.matcher, device=args.device)
+        self.output_folder = get_output_folder(args)
+        self.output_folder.mkdir(exist_ok=True)
 
-    for txt_file in tqdm(txt_files[start_query : start_query + num_queries]):
-        q_num = Path(txt_file).stem
-        out_file = output_folder.joinpath(f"{q_num}.torch")
-        if out_file.exists():
-            continue
-        results = []
+        self.use_features = has_extractor(self.matcher)
+        self.feature_cache = None
+        if args.features_cache_dir is not None:
+            if self.use_features:
+                self.feature_cache = FeatureCache(args.features_cache_dir, args.matcher, args.im_size)
+            else:
+                print(f"{args.matcher} doesn't match features with LightGlue, so its features can't be cached")
+        self.match_cache = None
+        if args.match_cache is not None:
+            self.match_cache = MatchCache(args.match_cache, args.matcher, args.im_size)
+        self.batch_size = args.match_batch_size
+        self.batch_lightglue = None
+        if self.batch_size > 1:
+            self.batch_lightglue = get_batch_lightglue(self.matcher) if self.use_features else None
+            if self.batch_lightglue is None:
+                print(
+                    f"{args.matcher} doesn't use LightGlue without adaptive depth and width, "
+                    "so its pairs are matched one at a time"
+                )
+
+        self.load_image = lambda path: self.matcher.load_image(path, resize=args.im_size)
+        self.prefetcher = None
+        if args.prefetch_threads > 0:
+            self.prefetcher = ImagePrefetcher(self.load_image, args.image_cache_size, args.prefetch_threads)
+            self.load_image = self.prefetcher.get
+
+    def get_out_file(self, txt_file):
+        return self.output_folder.joinpath(f"{Path(txt_file).stem}.torch")
+
+    def get_pairs_to_match(self, txt_file):
         q_path, pred_paths = read_file_preds(txt_file)
-        img0 = matcher.load_image(q_path, resize=img_size)
-        for pred_path in pred_paths[:num_preds]:
-            img1 = matcher.load_image(pred_path, resize=img_size)
-            result = matcher(deepcopy(img0), img1)
-            result["all_desc0"] = result["all_desc1"] = None
-            results.append(result)
-        torch.save(results, out_file)
+        pred_paths = pred_paths[: self.num_preds]
+        results = self.match_cache.get(q_path, pred_paths) if self.match_cache is not None else {}
+        missing_paths = list(dict.fromkeys(path for path in pred_paths if path not in results))
+        if self.prefetcher is not None and len(missing_paths) > 0:
+            # Images whose features are cached don't need to be decoded
+            paths_to_decode = [q_path] + missing_paths
+            if self.feature_cache is not None:
+                paths_to_decode = [p for p in paths_to_decode if not self.feature_cache.get_path(p).exists()]
+            self.prefetcher.prefetch(paths_to_decode)
+        return q_path, pred_paths, results, missing_paths
+
+    def match(self, txt_files, show_progress=True):
+        """Match the queries of txt_files which don't have an output file yet, and
+        return the number of pairs that were matched (i.e. not found in the cache)."""
+        txt_files = [txt_file for txt_file in txt_files if not self.get_out_file(txt_file).exists()]
+        num_matched_pairs = 0
+        next_pairs = self.get_pairs_to_match(txt_files[0]) if len(txt_files) > 0 else None
+        for i, txt_file in enumerate(tqdm(txt_files, disable=not show_progress)):
+            q_path, pred_paths, results, missing_paths = next_pairs
+            # The images of the next query are decoded while the current one is matched
+            if i + 1 < len(txt_files):
+                next_pairs = self.get_pairs_to_match(txt_files[i + 1])
+            new_results = match_pairs(
+                self.matcher,
+                q_path,
+                missing_paths,
+                self.load_image,
+                self.use_features,
+                self.feature_cache,
+                self.batch_lightglue,
+                self.batch_size,
+            )
+            if self.match_cache is not None:
+                self.match_cache.put(q_path, new_results)
+            num_matched_pairs += len(new_results)
+            results.update(new_results)
+            results = [results[pred_path] for pred_path in pred_paths]
+            # Written to a temporary file and renamed, so that an interrupted run never leaves a partial output
+            out_file = self.get_out_file(txt_file)
+            tmp_file = out_file.with_suffix(f".{os.getpid()}.tmp")
+            torch.save(results, tmp_file)
+            os.replace(tmp_file, out_file)
+        return num_matched_pairs
+
+    def close(self):
+        for cache in [self.feature_cache, self.match_cache, self.prefetcher]:
+            if cache is not None:
+                print(cache)
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+def main(args):
+    queries_matcher = QueriesMatcher(args)
+    queries_matcher.match(get_txt_files(args))
+    queries_matcher.close()
 
 if __name__ == "__main__":
     args = parse_arguments()
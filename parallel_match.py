@@ -0,0 +1,198 @@
+"""Run match_queries_preds.py with multiple worker processes, each pinned to its
+own share of the CPU cores. The queries are split in chunks which the workers
+pull as soon as they are idle, so that slow queries don't stall the others.
+Crashed workers are restarted and their chunk is retried, and since queries
+with an output file are skipped, an interrupted run is resumed by running the
+same command again. It takes the same arguments as match_queries_preds.py, e.g.
+
+    python parallel_match.py --preds-dir logs/log_dir/<TIMESTAMP>/preds --matcher superpoint-lg \\
+        --num-workers 16 --threads-per-worker 4
+"""
+
+import os
+import sys
+import time
+import queue
+import traceback
+import multiprocessing
+from collections import Counter, deque
+from pathlib import Path
+from tqdm import tqdm
+
+import match_queries_preds
+
+
+def get_worker_cores(worker_id, threads_per_worker):
+    """Return the CPU cores of a worker, a disjoint share of the available cores (wrapping around)."""
+    if not hasattr(os, "sched_getaffinity"):
+        return None  # CPU affinity is only supported on Linux
+    cores = sorted(os.sched_getaffinity(0))
+    return {cores[(worker_id * threads_per_worker + i) % len(cores)] for i in range(threads_per_worker)}
+
+
+def worker(worker_key, args, cores, task_queue, result_queue):
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    import torch
+
+    torch.set_num_threads(args.threads_per_worker)
+    try:
+        import cv2
+
+        cv2.setNumThreads(args.threads_per_worker)
+    except ImportError:
+        pass
+    queries_matcher = match_queries_preds.QueriesMatcher(args)
+    result_queue.put(("ready", worker_key, None, None))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        chunk_id, txt_files = task
+        try:
+            num_matched_pairs = queries_matcher.match(txt_files, show_progress=False)
+        except Exception:
+            result_queue.put(("failed", worker_key, chunk_id, traceback.format_exc()))
+            continue
+        result_queue.put(("done", worker_key, chunk_id, num_matched_pairs))
+    queries_matcher.close()
+
+
+class Orchestrator:
+    """Spawn the workers, assign them the chunks of queries, and restart them when they crash."""
+
+    def __init__(self, args, chunks):
+        self.args = args
+        self.chunks = chunks
+        self.context = multiprocessing.get_context("spawn")
+        self.result_queue = self.context.Queue()
+        self.workers, self.task_queues = {}, {}
+        # Restarted workers get a new key, so that the messages sent before a crash are ignored
+        self.worker_keys = {}
+        self.num_restarts = 0
+        # Chunks assigned to each worker, and idle workers waiting for a chunk
+        self.assigned_chunks, self.idle_workers = {}, deque()
+        self.pending_chunks = deque(range(len(chunks)))
+        self.num_failures = Counter()
+        self.failed_chunks = []
+        self.num_matched_pairs = 0
+
+    def start_worker(self, worker_id):
+        self.task_queues[worker_id] = self.context.Queue()
+        self.worker_keys[worker_id] = (worker_id, self.worker_keys.get(worker_id, (None, -1))[1] + 1)
+        cores = get_worker_cores(worker_id, self.args.threads_per_worker)
+        self.workers[worker_id] = self.context.Process(
+            target=worker,
+            args=(self.worker_keys[worker_id], self.args, cores, self.task_queues[worker_id], self.result_queue),
+            daemon=True,
+        )
+        self.workers[worker_id].start()
+
+    def retry_chunk(self, chunk_id, error):
+        self.num_failures[chunk_id] += 1
+        if self.num_failures[chunk_id] > self.args.max_retries:
+            print(f"Chunk {chunk_id} failed {self.num_failures[chunk_id]} times, giving up on it:\n{error}")
+            self.failed_chunks.append(chunk_id)
+        else:
+            print(f"Chunk {chunk_id} failed, retrying it:\n{error}")
+            self.pending_chunks.append(chunk_id)
+
+    def assign_chunks(self):
+        while self.idle_workers and self.pending_chunks:
+            worker_id, chunk_id = self.idle_workers.popleft(), self.pending_chunks.popleft()
+            if self.workers[worker_id].is_alive():
+                self.assigned_chunks[worker_id] = chunk_id
+                self.task_queues[worker_id].put((chunk_id, self.chunks[chunk_id]))
+            else:
+                self.pending_chunks.appendleft(chunk_id)
+
+    def check_workers(self):
+        for worker_id, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            # The worker crashed (e.g. killed by the OOM killer), its chunk is retried by another worker
+            chunk_id = self.assigned_chunks.pop(worker_id, None)
+            if chunk_id is not None:
+                self.retry_chunk(chunk_id, f"worker {worker_id} died with exit code {process.exitcode}")
+            if worker_id in self.idle_workers:
+                self.idle_workers.remove(worker_id)
+            self.num_restarts += 1
+            if self.num_restarts > self.args.num_workers * (self.args.max_retries + 1):
+                raise RuntimeError(f"Workers crashed {self.num_restarts} times, the last with exit code {process.exitcode}")
+            self.start_worker(worker_id)
+
+    def run(self):
+        num_queries = sum(len(chunk) for chunk in self.chunks)
+        start_time = time.perf_counter()
+        for worker_id in range(self.args.num_workers):
+            self.start_worker(worker_id)
+        progress_bar = tqdm(total=num_queries, unit="queries")
+        while self.pending_chunks or self.assigned_chunks:
+            self.check_workers()
+            self.assign_chunks()
+            try:
+                message, worker_key, chunk_id, content = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            worker_id = worker_key[0]
+            if worker_key != self.worker_keys[worker_id]:
+                continue  # Sent by a worker that crashed afterwards, its chunk was already retried
+            if message == "done":
+                self.assigned_chunks.pop(worker_id)
+                self.num_matched_pairs += content
+                progress_bar.update(len(self.chunks[chunk_id]))
+                pairs_per_sec = self.num_matched_pairs / (time.perf_counter() - start_time)
+                progress_bar.set_postfix(pairs_per_sec=f"{pairs_per_sec:.1f}")
+            elif message == "failed":
+                self.assigned_chunks.pop(worker_id)
+                self.retry_chunk(chunk_id, content)
+            self.idle_workers.append(worker_id)
+        progress_bar.close()
+        for worker_id, process in self.workers.items():
+            if process.is_alive():
+                self.task_queues[worker_id].put(None)
+        for process in self.workers.values():
+            process.join()
+        elapsed = time.perf_counter() - start_time
+        print(
+            f"Matched {self.num_matched_pairs} pairs in {elapsed:.1f} s with {self.args.num_workers} workers: "
+            f"{self.num_matched_pairs / elapsed:.1f} pairs/s"
+        )
+        if self.failed_chunks:
+            failed_queries = [Path(txt_file).stem for i in self.failed_chunks for txt_file in self.chunks[i]]
+            print(f"Some queries could not be matched, run the same command again to retry them: {failed_queries}")
+            sys.exit(1)
+
+
+def parse_arguments():
+    parser = match_queries_preds.get_parser()
+    parser.add_argument("--num-workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--threads-per-worker", type=int, default=4, help="CPU threads (and cores) of each worker")
+    parser.add_argument("--chunk-size", type=int, default=4, help="number of queries in each chunk of work")
+    parser.add_argument("--max-retries", type=int, default=2, help="retries of a chunk whose worker crashed")
+    args = parser.parse_args()
+    if args.num_workers is None:
+        args.num_workers = max(1, os.cpu_count() // args.threads_per_worker)
+    return args
+
+
+def main(args):
+    output_folder = match_queries_preds.get_output_folder(args)
+    output_folder.mkdir(exist_ok=True)
+    # Queries matched by a previous (possibly interrupted) run are skipped
+    txt_files = [
+        txt_file
+        for txt_file in match_queries_preds.get_txt_files(args)
+        if not output_folder.joinpath(f"{Path(txt_file).stem}.torch").exists()
+    ]
+    chunks = [txt_files[i : i + args.chunk_size] for i in range(0, len(txt_files), args.chunk_size)]
+    if len(chunks) == 0:
+        print(f"All the queries are already matched in {output_folder}")
+        return
+    print(f"Matching {len(txt_files)} queries in {len(chunks)} chunks with {args.num_workers} workers")
+    Orchestrator(args, chunks).run()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -1,12 +1,15 @@
-import numpy as np
 from tqdm import tqdm
-import os, argparse
+import os, argparse, sys
 from glob import glob
 from pathlib import Path
 import torch
 
 from util import get_list_distances_from_preds
 
+sys.path.append(str(Path(__file__).parent.joinpath("VPR-methods-evaluation")))
+
+from evaluation import compute_recalls
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
     
@@ -40,9 +43,10 @@ def main(args):
     txt_files.sort(key=lambda x: int(Path(x).stem))
 
     total_queries = len(txt_files)
-    recalls = np.zeros(len(recall_values))
+    # Geographic distances of the re-ranked predictions of each query
+    reranked_geo_dists = torch.zeros(total_queries, num_preds)
 
-    for txt_file_query in tqdm(txt_files):
+    for itr, txt_file_query in enumerate(tqdm(txt_files)):
         geo_dists = torch.tensor(get_list_distances_from_preds(txt_file_query))[:num_preds]
         torch_file_query = inliers_folder.joinpath(Path(txt_file_query).name.replace('txt', 'torch'))
         query_results = torch.load(torch_file_query, weights_only=False)
@@ -50,14 +54,9 @@ def main(args):
         for i in range(num_preds):
             query_db_inliers[i] = query_results[i]['num_inliers']
         query_db_inliers, indices = torch.sort(query_db_inliers, descending=True)
-        geo_dists = geo_dists[indices]
-        
-        for i, n in enumerate(recall_values):
-            if torch.any(geo_dists[:n] <= threshold):
-                recalls[i:] += 1
-                break
+        reranked_geo_dists[itr] = geo_dists[indices]
 
-    recalls = recalls / total_queries * 100
+    recalls = compute_recalls((reranked_geo_dists <= threshold).numpy(), recall_values)
     recalls_str = ", ".join([f"R@{val}: {rec:.1f}" for val, rec in zip(recall_values, recalls)])
 
     print(recalls_str)
@@ -0,0 +1,92 @@
+"""Tests that matching a query with several predictions in one forward pass of LightGlue
+(batch_matching.py) gives the same results as matching each pair on its own.
+They need LightGlue and the image-matching-models submodule, and are run with
+    python -m pytest tests
+"""
+
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+lightglue = pytest.importorskip("lightglue")
+match_queries_preds = pytest.importorskip("match_queries_preds")
+
+import batch_matching  # noqa: E402
+
+
+def get_features(num_kpts, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return {
+        "keypoints": torch.rand(1, num_kpts, 2, generator=generator) * 512,
+        "descriptors": torch.nn.functional.normalize(torch.randn(1, num_kpts, 256, generator=generator), dim=-1),
+        "scales": torch.rand(1, num_kpts, generator=generator) * 4,
+        "oris": (torch.rand(1, num_kpts, generator=generator) - 0.5) * 2 * np.pi,
+        "image_size": torch.tensor([[512.0, 384.0]]),
+    }
+
+
+def get_matcher(add_scale_ori=False, **conf):
+    torch.manual_seed(0)
+    # Without pretrained weights, so that the test doesn't download them
+    lightglue_model = lightglue.LightGlue(features=None, add_scale_ori=add_scale_ori, filter_threshold=0, **conf)
+    # All the matches are kept as inliers, so that num_inliers is the number of matches
+    return SimpleNamespace(
+        extractor=object(),
+        matcher=lightglue_model.eval(),
+        device="cpu",
+        process_matches=lambda k0, k1: (None, k0, k1),
+    )
+
+
+def test_get_batch_lightglue():
+    assert batch_matching.get_batch_lightglue(get_matcher(depth_confidence=-1, width_confidence=-1)) is not None
+    # With adaptive depth and width each pair stops and prunes on its own, so it can't be batched
+    assert batch_matching.get_batch_lightglue(get_matcher()) is None
+    assert batch_matching.get_batch_lightglue(SimpleNamespace(extractor=object(), matcher=object())) is None
+
+
+@pytest.mark.parametrize("add_scale_ori", [False, True])
+def test_batch_same_as_per_pair(add_scale_ori):
+    matcher = get_matcher(add_scale_ori, depth_confidence=-1, width_confidence=-1)
+    lightglue_model = batch_matching.get_batch_lightglue(matcher)
+    feats0 = get_features(180, seed=0)
+    # Different numbers of keypoints, so that all but the largest are padded
+    feats1_list = [get_features(num_kpts, seed) for seed, num_kpts in enumerate([150, 37, 211, 211, 1, 96], 1)]
+
+    batch_matches = batch_matching.match_features_batch(lightglue_model, feats0, feats1_list)
+    assert len(batch_matches) == len(feats1_list)
+    num_matches = 0
+    for feats1, matches in zip(feats1_list, batch_matches):
+        expected = match_queries_preds.match_features(matcher, feats0, feats1)
+        result = match_queries_preds.match_features(matcher, feats0, feats1, matches)
+        assert result["num_inliers"] == expected["num_inliers"]
+        np.testing.assert_array_equal(result["matched_kpts0"], expected["matched_kpts0"])
+        np.testing.assert_array_equal(result["matched_kpts1"], expected["matched_kpts1"])
+        num_matches += result["num_inliers"]
+    assert num_matches > 0
+
+
+def test_match_pairs_batched_same_as_per_pair():
+    matcher = get_matcher(depth_confidence=-1, width_confidence=-1)
+    nums_kpts = {"query": 120, "db_0": 64, "db_1": 120, "db_2": 9, "db_3": 150, "db_4": 77}
+    features = {path: get_features(num_kpts, seed) for seed, (path, num_kpts) in enumerate(nums_kpts.items())}
+    pred_paths = [path for path in nums_kpts if path != "query"]
+    # The images are the paths themselves, from which the extractor gets the features
+    matcher.extractor = SimpleNamespace(extract=lambda img: features[img.path])
+    load_image = lambda path: SimpleNamespace(path=path, to=lambda device: SimpleNamespace(path=path))
+
+    per_pair = match_queries_preds.match_pairs(matcher, "query", pred_paths, load_image, True)
+    batched = match_queries_preds.match_pairs(
+        matcher, "query", pred_paths, load_image, True, batch_lightglue=matcher.matcher, batch_size=2
+    )
+    assert set(batched) == set(per_pair) == set(pred_paths)
+    for path in pred_paths:
+        assert batched[path]["num_inliers"] == per_pair[path]["num_inliers"]
+        np.testing.assert_array_equal(batched[path]["matched_kpts0"], per_pair[path]["matched_kpts0"])
+        np.testing.assert_array_equal(batched[path]["matched_kpts1"], per_pair[path]["matched_kpts1"])
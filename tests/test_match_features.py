@@ -0,0 +1,58 @@
+"""Tests of the matching of the features of detector-based matchers in match_queries_preds.py.
+They need LightGlue and the image-matching-models submodule, and are run with
+    python -m pytest tests
+"""
+
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+lightglue = pytest.importorskip("lightglue")
+match_queries_preds = pytest.importorskip("match_queries_preds")
+
+
+def get_features(num_kpts, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return {
+        "keypoints": torch.rand(1, num_kpts, 2, generator=generator) * 512,
+        "descriptors": torch.nn.functional.normalize(torch.randn(1, num_kpts, 256, generator=generator), dim=-1),
+        "image_size": torch.tensor([[512.0, 512.0]]),
+    }
+
+
+def get_matcher():
+    torch.manual_seed(0)
+    # Without pretrained weights, so that the test doesn't download them
+    lightglue_model = lightglue.LightGlue(features=None, filter_threshold=0).eval()
+    # All the matches are kept as inliers, so that num_inliers is the number of matches
+    return SimpleNamespace(
+        extractor=object(), matcher=lightglue_model, device="cpu", process_matches=lambda k0, k1: (None, k0, k1)
+    )
+
+
+def test_has_extractor():
+    matcher = get_matcher()
+    assert match_queries_preds.has_extractor(matcher)
+    # Matchers whose matcher is not LightGlue are run on the pairs of images
+    assert not match_queries_preds.has_extractor(SimpleNamespace(extractor=object(), matcher=object()))
+    assert not match_queries_preds.has_extractor(SimpleNamespace(matcher=matcher.matcher))
+
+
+def test_match_features_with_lightglue_output():
+    matcher = get_matcher()
+    feats0, feats1 = get_features(200, seed=0), get_features(150, seed=1)
+    with torch.inference_mode():
+        # LightGlue returns the matches of each image of the batch in a list
+        matches = matcher.matcher({"image0": feats0, "image1": feats1})["matches"]
+    assert isinstance(matches, list)
+    result = match_queries_preds.match_features(matcher, feats0, feats1)
+    assert result["num_inliers"] == len(matches[0]) > 0
+    np.testing.assert_array_equal(result["matched_kpts0"], feats0["keypoints"][0][matches[0][:, 0]].numpy())
+    np.testing.assert_array_equal(result["matched_kpts1"], feats1["keypoints"][0][matches[0][:, 1]].numpy())
+    np.testing.assert_array_equal(result["all_kpts1"], feats1["keypoints"][0].numpy())